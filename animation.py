@@ -0,0 +1,172 @@
+"""
+Playing back runs of canvas tiles as animations, next to the editor:
+
+    animation = Animation(canvas, [(0, 3), (1, 3), (2, 3)], fps=8)
+    animation.play()
+
+and then, each time the window showing it is drawn:
+
+    animation.draw(x, y, scale)
+
+Each frame is baked into a texture atlas once, and only baked again when the
+canvas cells it shows change, so playback costs next to nothing per tick.
+"""
+
+__author__ = 'cseebach'
+
+from itertools import product
+
+import pyglet
+from pyglet import gl
+
+from model import uploads
+
+class Animation(object):
+    """
+    A sequence of frames, each a rectangle of canvas cells, played back on
+    pyglet's clock at some number of frames per second.
+
+    Every frame is baked, with its tiles' transforms applied, into its own
+    region of a texture atlas. A tick only points the animation's one sprite
+    at the next frame's region: no sprites are made and nothing is copied from
+    the canvas. The canvas's changes are looked at when the animation is
+    drawn, and only the frames showing a changed cell are baked again.
+    """
+
+    atlas_size = 1024, 1024
+
+    def __init__(self, canvas, frames, fps=8):
+        """
+        Create an animation of a canvas's cells. Each frame is either a
+        (tile_x, tile_y) cell, or a (tile_x, tile_y, columns, rows) rectangle
+        of cells with (tile_x, tile_y) at its bottom left. Every frame must be
+        the same size.
+        """
+        if not frames:
+            raise ValueError("an animation needs at least one frame")
+        self.canvas = canvas
+        self.frames = [tuple(frame) if len(frame) == 4
+                       else tuple(frame) + (1, 1) for frame in frames]
+        if len(set(frame[2:] for frame in self.frames)) > 1:
+            raise ValueError("the frames of an animation must be the same size")
+
+        #the frames showing each cell, for finding the ones to bake again
+        self.frames_by_cell = {}
+        columns, rows = canvas.canvas_size
+        for index, (left, bottom, width, height) in enumerate(self.frames):
+            if left < 0 or bottom < 0 or left + width > columns or \
+                    bottom + height > rows:
+                raise ValueError("frame %d is not on the canvas" % index)
+            for cell in product(xrange(left, left + width),
+                                xrange(bottom, bottom + height)):
+                self.frames_by_cell.setdefault(cell, []).append(index)
+
+        self.fps = fps
+        self.current = 0
+        self.playing = False
+
+        self.atlas = None
+        self.filtered = set()
+        self.regions = [None] * len(self.frames)
+        self.sprite = None
+        #the name the canvas keeps this animation's changes under
+        self.consumer = "animation %d" % id(self)
+
+    def get_size(self):
+        """
+        Returns the width and height of a frame, in pixels.
+        """
+        columns, rows = self.frames[0][2:]
+        return columns * self.canvas.tile_size[0], rows * self.canvas.tile_size[1]
+
+    def get_frame_bytes(self, index):
+        """
+        Returns the pixels of a frame, with tile transforms applied, as one
+        bytearray of RGBA rows starting from the bottom.
+        """
+        return self.canvas.get_cells_bytes(*self.frames[index])
+
+    def bake(self, index):
+        """
+        Put a frame's pixels into its region of the atlas, giving it one the
+        first time.
+        """
+        width, height = self.get_size()
+        image = pyglet.image.ImageData(width, height, "RGBA",
+                                       str(self.get_frame_bytes(index)))
+        region = self.regions[index]
+        if region is None:
+            region = self.regions[index] = self.atlas.add(image)
+            if region.id not in self.filtered:
+                gl.glBindTexture(region.target, region.id)
+                gl.glTexParameteri(region.target, gl.GL_TEXTURE_MAG_FILTER,
+                                   gl.GL_NEAREST)
+                gl.glTexParameteri(region.target, gl.GL_TEXTURE_MIN_FILTER,
+                                   gl.GL_NEAREST)
+                self.filtered.add(region.id)
+        else:
+            region.blit_into(image, 0, 0, 0)
+        uploads.count(width * height * 4)
+
+    def update(self):
+        """
+        Bake every frame that hasn't been baked yet, or that shows a cell that
+        has changed since the last update.
+        """
+        if self.atlas is None:
+            self.atlas = pyglet.image.atlas.TextureBin(*self.atlas_size)
+        stale = set(index for index, region in enumerate(self.regions)
+                    if region is None)
+        for cell in self.canvas.take_changes(self.consumer):
+            stale.update(self.frames_by_cell.get(cell, ()))
+        for index in sorted(stale):
+            self.bake(index)
+
+    def tick(self, dt):
+        self.current = (self.current + 1) % len(self.frames)
+        if self.sprite is not None:
+            self.sprite.image = self.regions[self.current]
+
+    def play(self):
+        if not self.playing:
+            pyglet.clock.schedule_interval(self.tick, 1.0 / self.fps)
+            self.playing = True
+
+    def stop(self):
+        if self.playing:
+            pyglet.clock.unschedule(self.tick)
+            self.playing = False
+
+    def set_fps(self, fps):
+        """
+        Change how many frames are shown a second, carrying on playing if the
+        animation is playing.
+        """
+        playing = self.playing
+        self.stop()
+        self.fps = max(1, fps)
+        if playing:
+            self.play()
+
+    def draw(self, x=0, y=0, scale=1):
+        """
+        Draw the current frame with its bottom left corner at (x, y).
+        """
+        self.update()
+        if self.sprite is None:
+            self.sprite = pyglet.sprite.Sprite(self.regions[self.current])
+        if (self.sprite.x, self.sprite.y) != (x, y):
+            self.sprite.position = x, y
+        if self.sprite.scale != scale:
+            self.sprite.scale = scale
+        self.sprite.draw()
+
+    def close(self):
+        """
+        Stop playing, and stop the canvas keeping changes for this animation.
+        """
+        self.stop()
+        self.canvas.drop_changes(self.consumer)
+        if self.sprite is not None:
+            self.sprite.delete()
+            self.sprite = None
@@ -0,0 +1,130 @@
+"""
+Run a script of tool operations over Pixel Slammer projects, without opening
+any windows:
+
+    python batch.py script.json level1.pslm level2.pslm --png -o out --jobs 4
+
+A script is a JSON object with a list of operations, applied in order:
+
+    {"operations": [
+        {"tool": "Rectangle", "color": [255, 0, 0, 255],
+         "points": [[0, 0], [15, 15]]},
+        {"tool": "FloodFill", "color": [0, 0, 255, 255], "points": [[4, 4]],
+         "tolerance": 8}
+    ]}
+
+Each operation's points are fed to the tool the way the mouse would: a press
+at the first point, a drag between each pair of points, and a release at the
+last. Any other keys are set as attributes on the tool before it is run.
+"""
+
+__author__ = 'cseebach'
+
+import argparse
+import json
+from multiprocessing import Pool
+import os
+import sys
+
+import pyglet
+pyglet.options["shadow_window"] = False
+
+from export import export_png, export_sheet
+from project import load_project, save_project
+from tools import EyeDropper, Filmstrip, tool_list
+
+#the eyedropper changes the controller's colors, and the filmstrip plays in a
+#window, so neither does anything to the canvas
+headless_tools = dict((tool.__name__, tool) for tool in tool_list
+                      if tool not in (EyeDropper, Filmstrip))
+
+def make_tool(operation):
+    """
+    Create a tool from one operation of a script, and send it its input.
+    """
+    operation = dict(operation)
+    name = operation.pop("tool")
+    if name not in headless_tools:
+        raise ValueError("%s can't be used in a script" % name)
+    color = tuple(operation.pop("color", (0, 0, 0, 255)))
+    points = operation.pop("points", None)
+    if not points:
+        raise ValueError("%s needs at least one point" % name)
+
+    tool = headless_tools[name](color, None)
+    for attribute, value in operation.iteritems():
+        setattr(tool, attribute, value)
+
+    tool.accept_press(*points[0])
+    tool.accept_path(points)
+    tool.accept_release(points[-1][0], points[-1][1], 0)
+    return tool
+
+def run_script(operations, canvas):
+    for operation in operations:
+        make_tool(operation).do(canvas)
+
+def process_project(job):
+    """
+    Load one project, run the script on it, and write out the results. Returns
+    the path of the project that was written.
+    """
+    path, operations, options = job
+    model = load_project(path)
+    run_script(operations, model.canvas)
+    if options["dedup"]:
+        model.canvas.deduplicate()
+
+    out_dir = options["out_dir"] or os.path.dirname(path)
+    name = os.path.splitext(os.path.basename(path))[0]
+    out_path = os.path.join(out_dir, name + ".pslm")
+    save_project(model, out_path, options["compress"])
+    if options["png"]:
+        export_png(model.canvas, os.path.join(out_dir, name + ".png"))
+    if options["sheet"]:
+        export_sheet(model.canvas, os.path.join(out_dir, name + "_sheet.png"),
+                     os.path.join(out_dir, name + "_sheet.json"))
+    return out_path
+
+def main(args):
+    parser = argparse.ArgumentParser(
+        description="Run a script of tool operations over projects.")
+    parser.add_argument("script", help="JSON file of operations to run")
+    parser.add_argument("projects", nargs="+", help="projects to process")
+    parser.add_argument("-o", "--out-dir", default=None,
+                        help="where to write results (default: in place)")
+    parser.add_argument("--png", action="store_true",
+                        help="also export each canvas as a PNG")
+    parser.add_argument("--sheet", action="store_true",
+                        help="also export each canvas as a sprite sheet")
+    parser.add_argument("--compress", action="store_true",
+                        help="write compressed projects")
+    parser.add_argument("--dedup", action="store_true",
+                        help="make repeated tiles share pixels, with transforms")
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+                        help="processes to use (default: one per CPU)")
+    options = parser.parse_args(args)
+
+    with open(options.script) as script_file:
+        operations = json.load(script_file)["operations"]
+    if options.out_dir and not os.path.isdir(options.out_dir):
+        os.makedirs(options.out_dir)
+
+    job_options = {"out_dir": options.out_dir, "png": options.png,
+                   "sheet": options.sheet, "compress": options.compress,
+                   "dedup": options.dedup}
+    jobs = [(path, operations, job_options) for path in options.projects]
+    if options.jobs == 1 or len(jobs) == 1:
+        for out_path in map(process_project, jobs):
+            print out_path
+    else:
+        pool = Pool(options.jobs)
+        try:
+            for out_path in pool.imap_unordered(process_project, jobs):
+                print out_path
+        finally:
+            pool.close()
+            pool.join()
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
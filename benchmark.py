@@ -0,0 +1,517 @@
+"""
+Timings for the slow paths in Pixel Slammer. These run without a display:
+
+    python benchmark.py [--skip-legacy] [--full]
+
+compares the flood fill and ellipses with the ones they replaced. The old flood
+fill takes minutes on a 256x256 canvas, and far longer on a 1024x1024 one, so
+it is only compared on the larger canvas with --full.
+
+    python benchmark.py --suite [--tiles 8,16,32] [--canvases 4,16,64]
+                        [--json results.json] [--compare old.json]
+
+times the hot paths of the model, tools and controller for every pair of tile
+size and canvas size (in tiles), and can write the results to JSON, or compare
+them with the JSON written by an earlier run to find regressions between
+commits. Drawing is timed in a hidden window if there is a display, and with
+mocked GL otherwise.
+"""
+
+__author__ = 'cseebach'
+
+import argparse
+from collections import defaultdict
+from contextlib import contextmanager
+from itertools import product
+import json
+import math
+import os
+import platform
+import subprocess
+import sys
+from timeit import default_timer
+
+import pyglet
+pyglet.options["shadow_window"] = False
+from pyglet import gl
+from pyglet.image.atlas import Allocator, AllocatorException
+
+from controller import SlammerCtrl
+import model
+from model import Canvas, PixelArea, SlammerModel
+from tools import FloodFill, Pencil, fill_ellipse, raster_ellipse, raster_line
+
+def bfs_fill(canvas, x, y, color):
+    """
+    The flood fill FloodFill used to do, kept here to compare against.
+    """
+    color_to_replace = canvas.get_pixel(x, y)
+    pixels_to_replace = set([(x, y)])
+
+    found_new = True
+    while found_new:
+        found_new = False
+        new_pixels = set()
+        for pixel in pixels_to_replace:
+            nearby_pixels = [(pixel[0]+1,pixel[1]),
+                             (pixel[0]-1,pixel[1]),
+                             (pixel[0],pixel[1]+1),
+                             (pixel[0],pixel[1]-1),]
+            for nearby_pixel in nearby_pixels:
+                if not (0 <= nearby_pixel[0] < canvas.width and
+                        0 <= nearby_pixel[1] < canvas.height):
+                    continue
+                if color_to_replace == canvas.get_pixel(*nearby_pixel):
+                    if nearby_pixel not in new_pixels:
+                        if nearby_pixel not in pixels_to_replace:
+                            found_new = True
+                            new_pixels.add(nearby_pixel)
+        pixels_to_replace.update(new_pixels)
+
+    for pixel in pixels_to_replace:
+        canvas.set_pixel(pixel[0], pixel[1], color)
+
+def round_up(number):
+    return int(round(number))
+
+def round_down(number):
+    return -int(round(-number))
+
+def ellipse_parametric_equation(angle, a, b, x_center, y_center):
+    x = math.cos(angle) * a
+    if x < 0:
+        x = round_down(x + x_center)
+    else:
+        x = round_up(x + x_center)
+
+    y = math.sin(angle) * b
+    if y < 0:
+        y = round_down(y + y_center)
+    else:
+        y = round_up(y + y_center)
+    return x, y
+
+def parametric_ellipse(start_x, start_y, end_x, end_y):
+    """
+    The ellipse outline raster_ellipse used to make, kept here to compare
+    against.
+    """
+    if start_x > end_x:
+        start_x, end_x = end_x, start_x
+    if start_y > end_y:
+        start_y, end_y = end_y, start_y
+
+    center_y = (start_y + end_y)/2.0
+    center_x = (start_x + end_x)/2.0
+    x_radius = end_x - center_x
+    y_radius = end_y - center_y
+
+    num_segments = max(int(x_radius * y_radius)*2, 16)
+
+    points = set()
+
+    last_point = ellipse_parametric_equation(0, x_radius, y_radius, center_x,
+                                             center_y)
+    for i in xrange(1, num_segments + 1):
+        angle = (float(i) / num_segments) * 2 * math.pi
+        this_point = ellipse_parametric_equation(angle, x_radius, y_radius,
+                                                 center_x, center_y)
+        points.update(raster_line(last_point[0], last_point[1],
+                                  this_point[0], this_point[1]))
+        last_point = this_point
+
+    return points
+
+def column_fill_ellipse(points):
+    """
+    The ellipse fill fill_ellipse used to do, kept here to compare against.
+    """
+    points_by_x = defaultdict(list)
+    for x, y in points:
+        points_by_x[x].append((x, y))
+
+    additional_points = []
+    for points_list in points_by_x.itervalues():
+        points_list.sort()
+        x, last_y = points_list[0]
+        for x, y in points_list[1:]:
+            if y - last_y > 1:
+                for new_y in xrange(last_y+1, y):
+                    additional_points.append((x, new_y))
+            last_y = y
+
+    return additional_points
+
+def time_it(function, *args, **kwargs):
+    """
+    Returns the best time, in seconds, out of some number of calls.
+    """
+    best = None
+    for i in xrange(kwargs.get("repeat", 1)):
+        start = default_timer()
+        function(*args)
+        elapsed = default_timer() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def empty_canvas(size, tile_size=16):
+    return Canvas((tile_size, tile_size), (size // tile_size, size // tile_size))
+
+def bench_fill(size, legacy=True):
+    """
+    Fill an empty size by size canvas, starting from a corner.
+    """
+    fill = FloodFill((255, 0, 0, 255), None)
+    fill.accept_press(0, 0)
+    fill.accept_release(0, 0, 0)
+
+    results = [("scanline fill", time_it(fill.do, empty_canvas(size)))]
+    if legacy:
+        results.append(("bfs fill", time_it(bfs_fill, empty_canvas(size), 0, 0,
+                                            (255, 0, 0, 255))))
+    return results
+
+def bench_ellipse(size, legacy=True):
+    """
+    Make the outline and fill of an ellipse filling a size by size box.
+    """
+    def midpoint():
+        fill_ellipse(raster_ellipse(0, 0, size - 1, size - 1))
+    def parametric():
+        column_fill_ellipse(parametric_ellipse(0, 0, size - 1, size - 1))
+
+    results = [("midpoint ellipse", time_it(midpoint, repeat=5))]
+    if legacy:
+        results.append(("parametric ellipse", time_it(parametric, repeat=5)))
+    return results
+
+def report(name, results):
+    print name
+    for label, seconds in results:
+        print "    %-24s %10.4fs" % (label, seconds)
+
+class HeadlessWindow(object):
+    """
+    Takes the calls the controller makes on a view's windows, and does nothing
+    with them.
+    """
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+
+class HeadlessView(object):
+    """
+    A view for driving a SlammerCtrl without any windows.
+    """
+
+    def __init__(self):
+        self.canvas = HeadlessWindow()
+        self.toolbox = HeadlessWindow()
+        self.tileset = HeadlessWindow()
+        self.animation = HeadlessWindow()
+
+    def push_handlers(self, handler):
+        pass
+
+class MockGL(object):
+    """
+    Stands in for pyglet.gl in the model when there is no display. The
+    constants are pyglet's own, and every function does nothing.
+    """
+
+    def __getattr__(self, name):
+        value = getattr(gl, name)
+        if callable(value):
+            return lambda *args: None
+        return value
+
+class MockVertexList(object):
+
+    def __init__(self, count, *data):
+        for attribute in data:
+            if isinstance(attribute, tuple):
+                name = {"v": "vertices", "t": "tex_coords"}[attribute[0][0]]
+                setattr(self, name, attribute[1])
+
+    def delete(self):
+        pass
+
+class MockBatch(object):
+
+    def add(self, count, mode, group, *data):
+        return MockVertexList(count, *data)
+
+    def migrate(self, vertex_list, mode, group, batch):
+        pass
+
+    def draw(self):
+        pass
+
+class MockTextureBin(object):
+    """
+    Packs images into atlas regions the way TextureBin does, without uploading
+    anything. The textures are pyglet Texture objects with made up names.
+    """
+
+    def __init__(self, texture_width=2048, texture_height=2048, border=False):
+        self.texture_width = texture_width
+        self.texture_height = texture_height
+        self.border = 1 if border else 0
+        self.atlases = []
+
+    def add(self, img):
+        size = img.width + self.border * 2, img.height + self.border * 2
+        for texture, allocator in self.atlases:
+            try:
+                x, y = allocator.alloc(*size)
+                break
+            except AllocatorException:
+                pass
+        else:
+            texture = pyglet.image.Texture(self.texture_width,
+                                           self.texture_height,
+                                           gl.GL_TEXTURE_2D,
+                                           len(self.atlases) + 1)
+            allocator = Allocator(self.texture_width, self.texture_height)
+            self.atlases.append((texture, allocator))
+            x, y = allocator.alloc(*size)
+        return texture.get_region(x + self.border, y + self.border,
+                                  img.width, img.height)
+
+@contextmanager
+def gl_context():
+    """
+    Run the body of a with statement with a GL context for the model to draw
+    with: a hidden window's if there is a display, and otherwise mocked GL,
+    which times only the work done on the CPU. Gives "window" or "mock".
+    """
+    try:
+        window = pyglet.window.Window(visible=False)
+    except Exception:
+        #there is no display (or no GL) to open a window on
+        window = None
+    if window is not None:
+        try:
+            yield "window"
+        finally:
+            window.close()
+        return
+
+    saved = model.gl, pyglet.graphics.Batch, pyglet.image.atlas.TextureBin
+    model.gl = MockGL()
+    pyglet.graphics.Batch = MockBatch
+    pyglet.image.atlas.TextureBin = MockTextureBin
+    try:
+        yield "mock"
+    finally:
+        model.gl, pyglet.graphics.Batch, pyglet.image.atlas.TextureBin = saved
+
+def best_of(repeat, setup, run):
+    """
+    Returns the best time, in seconds, of some number of runs. Each run is
+    passed a fresh result of setup, which isn't timed.
+    """
+    best = None
+    for i in xrange(repeat):
+        state = setup()
+        start = default_timer()
+        run(state)
+        elapsed = default_timer() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def pencil_stroke(points):
+    pencil = Pencil((255, 0, 0, 255), None)
+    pencil.accept_press(*points[0])
+    for start, end in zip(points, points[1:]):
+        pencil.accept_drag(start[0], start[1], end[0], end[1])
+    pencil.accept_release(points[-1][0], points[-1][1], 0)
+    return pencil
+
+def suite_cases(tile_size, canvas_size, undo_depth):
+    """
+    Returns (name, setup, run) for each case of the suite, for canvases of
+    canvas_size by canvas_size tiles, each tile_size by tile_size pixels.
+    """
+    size = tile_size * canvas_size
+    color = (255, 0, 0, 255)
+    tile_pixels = list(product(xrange(tile_size), xrange(tile_size)))
+
+    def new_area():
+        return PixelArea(tile_size, tile_size)
+    def new_canvas():
+        return Canvas((tile_size, tile_size), (canvas_size, canvas_size))
+    def drawn_canvas():
+        canvas = new_canvas()
+        canvas.fill_rect(0, 0, size, size, color)
+        return canvas
+
+    def area_set_pixel(area):
+        for x, y in tile_pixels:
+            area.set_pixel(x, y, color)
+    def area_get_pixel(area):
+        for x, y in tile_pixels:
+            area.get_pixel(x, y)
+    def area_copy(area):
+        for i in xrange(1000):
+            area.copy()
+    def canvas_set_pixel(canvas):
+        #a row and a column through every tile, crossing each tile boundary
+        middle = size // 2
+        for i in xrange(size):
+            canvas.set_pixel(i, middle, color)
+            canvas.set_pixel(middle, i, color)
+
+    def fill(canvas):
+        flood_fill = FloodFill(color, None)
+        flood_fill.accept_press(0, 0)
+        flood_fill.accept_release(0, 0, 0)
+        flood_fill.do(canvas)
+
+    def undo_setup():
+        ctrl = SlammerCtrl(SlammerModel((tile_size, tile_size),
+                                        (canvas_size, canvas_size)),
+                           HeadlessView())
+        for i in xrange(undo_depth):
+            ctrl.history.do(pencil_stroke([(0, i % size),
+                                           (size - 1, (i * 7) % size)]),
+                            ctrl.model.canvas)
+        return ctrl
+    def undo_all(ctrl):
+        for i in xrange(undo_depth):
+            ctrl.undo()
+
+    def stroked_canvas():
+        canvas = drawn_canvas()
+        canvas.get_batch(1)
+        pencil_stroke([(0, 0), (size - 1, size - 1)]).do(canvas)
+        return canvas
+
+    return [
+        ("PixelArea.set_pixel", new_area, area_set_pixel),
+        ("PixelArea.get_pixel", new_area, area_get_pixel),
+        ("PixelArea.erase", new_area, lambda area: area.erase()),
+        ("PixelArea.copy x1000", new_area, area_copy),
+        ("Canvas.set_pixel", new_canvas, canvas_set_pixel),
+        ("Canvas.copy", drawn_canvas, lambda canvas: canvas.copy()),
+        ("raster_line", lambda: None,
+         lambda state: raster_line(0, 0, size - 1, size // 3)),
+        ("raster_ellipse", lambda: None,
+         lambda state: raster_ellipse(0, 0, size - 1, size - 1)),
+        ("fill_ellipse", lambda: raster_ellipse(0, 0, size - 1, size - 1),
+         fill_ellipse),
+        ("FloodFill.do", new_canvas, fill),
+        ("SlammerCtrl.undo x%d" % undo_depth, undo_setup, undo_all),
+        ("Canvas.get_batch, first", drawn_canvas,
+         lambda canvas: canvas.get_batch(1)),
+        ("Canvas.get_batch, after stroke", stroked_canvas,
+         lambda canvas: canvas.get_batch(1)),
+    ]
+
+def run_suite(tile_sizes, canvas_sizes, repeat, undo_depth):
+    """
+    Time every case of the suite for every tile size and canvas size. Returns
+    the results, ready to be written out as JSON.
+    """
+    results = []
+    with gl_context() as context:
+        for tile_size in tile_sizes:
+            for canvas_size in canvas_sizes:
+                for name, setup, run in suite_cases(tile_size, canvas_size,
+                                                    undo_depth):
+                    results.append({"case": name, "tile_size": tile_size,
+                                    "canvas_size": canvas_size,
+                                    "seconds": best_of(repeat, setup, run)})
+    meta = {"python": platform.python_version(),
+            "numpy": model.numpy is not None, "gl": context,
+            "repeat": repeat, "commit": git_commit()}
+    return {"meta": meta, "results": results}
+
+def git_commit():
+    """
+    Returns the commit the working tree is at, or None if it isn't known.
+    """
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.STDOUT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def result_key(result):
+    return result["case"], result["tile_size"], result["canvas_size"]
+
+def report_suite(suite, baseline=None, threshold=0.1):
+    """
+    Print the results of the suite. Given the results of an earlier run, each
+    case is compared with it, and cases that got slower by more than the
+    threshold are marked.
+    """
+    before = {}
+    if baseline:
+        before = dict((result_key(result), result["seconds"])
+                      for result in baseline["results"])
+    print "gl: %(gl)s, numpy: %(numpy)s, commit: %(commit)s" % suite["meta"]
+    for result in suite["results"]:
+        line = "    %-32s %3dpx %3d tiles %10.4fs" % (
+            result["case"], result["tile_size"], result["canvas_size"],
+            result["seconds"])
+        old = before.get(result_key(result))
+        if old:
+            change = result["seconds"] / old - 1
+            line += " %+7.1f%%%s" % (change * 100,
+                                     " SLOWER" if change > threshold else "")
+        print line
+
+def size_list(text):
+    return [int(size) for size in text.split(",")]
+
+def main(args):
+    parser = argparse.ArgumentParser(
+        description="Time the slow paths in Pixel Slammer.")
+    parser.add_argument("--skip-legacy", action="store_true",
+                        help="don't time the replaced fill and ellipses")
+    parser.add_argument("--full", action="store_true",
+                        help="compare the old fill on the larger canvas too")
+    parser.add_argument("--suite", action="store_true",
+                        help="time the hot paths instead")
+    parser.add_argument("--tiles", type=size_list, default=[8, 16, 32],
+                        help="tile sizes to run the suite with")
+    parser.add_argument("--canvases", type=size_list, default=[4, 16, 64],
+                        help="canvas sizes, in tiles, to run the suite with")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="runs of each case, of which the best is kept")
+    parser.add_argument("--undo-depth", type=int, default=50,
+                        help="actions to undo in the undo case")
+    parser.add_argument("--json", default=None,
+                        help="write the suite's results to this file")
+    parser.add_argument("--compare", default=None,
+                        help="compare with results written by an earlier run")
+    options = parser.parse_args(args)
+
+    if options.suite:
+        suite = run_suite(options.tiles, options.canvases, options.repeat,
+                          options.undo_depth)
+        baseline = None
+        if options.compare:
+            with open(options.compare) as baseline_file:
+                baseline = json.load(baseline_file)
+        report_suite(suite, baseline)
+        if options.json:
+            with open(options.json, "w") as results_file:
+                json.dump(suite, results_file, indent=2, sort_keys=True)
+        return
+
+    legacy = not options.skip_legacy
+    for size in (32, 128, 512):
+        report("ellipse, %dx%d box" % (size, size),
+               bench_ellipse(size, legacy))
+    for size in (256, 1024):
+        report("flood fill, %dx%d canvas" % (size, size),
+               bench_fill(size, legacy and (options.full or size <= 256)))
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,85 @@
+"""
+Writing canvases out as images, without needing a window or a GL context:
+
+    export_png(canvas, "level.png")
+    export_sheet(canvas, "tiles.png", "tiles.json")
+"""
+
+__author__ = 'cseebach'
+
+import json
+import math
+import os
+import struct
+import zlib
+
+def png_chunk(chunk_type, data):
+    return (struct.pack(">I", len(data)) + chunk_type + data +
+            struct.pack(">I", zlib.crc32(chunk_type + data) & 0xffffffff))
+
+def write_png(path, width, height, pixels):
+    """
+    Write RGBA pixels to a PNG file. The pixels are rows of width * 4 bytes,
+    starting with the bottom row, the way pyglet and the canvas store them.
+    """
+    pitch = width * 4
+    pixels = buffer(pixels)
+    #PNG rows go from the top down, and each starts with a filter type byte
+    rows = []
+    for y in xrange(height - 1, -1, -1):
+        rows.append("\0")
+        rows.append(pixels[y * pitch:(y + 1) * pitch])
+
+    with open(path, "wb") as png_file:
+        png_file.write("\x89PNG\r\n\x1a\n")
+        png_file.write(png_chunk("IHDR", struct.pack(">IIBBBBB", width, height,
+                                                     8, 6, 0, 0, 0)))
+        png_file.write(png_chunk("IDAT", zlib.compress("".join(rows))))
+        png_file.write(png_chunk("IEND", ""))
+
+def export_png(canvas, path):
+    """
+    Write the whole canvas, with tile transforms applied, to one PNG file.
+    """
+    write_png(path, canvas.width, canvas.height, canvas.get_composite())
+
+def export_sheet(canvas, path, atlas_path=None, columns=None):
+    """
+    Write every tile of the canvas, with its transforms applied, side by side
+    into a sprite sheet PNG, and describe where each one is in a JSON atlas.
+
+    Tiles are laid out in rows of columns tiles (by default, as close to a
+    square as possible), starting from the canvas's top left tile. Frames in
+    the atlas are named tile_<x>_<y> after their place on the canvas, and are
+    measured from the top left of the sheet. The atlas also gives how many of
+    the tiles are unique, counting rotated and flipped tiles as the same.
+    """
+    tile_w, tile_h = canvas.tile_size
+    canvas_w, canvas_h = canvas.canvas_size
+    cells = [(x, y) for y in reversed(xrange(canvas_h))
+             for x in xrange(canvas_w)]
+    columns = columns or int(math.ceil(math.sqrt(len(cells))))
+    rows = -(-len(cells) // columns)
+
+    sheet_w, sheet_h = columns * tile_w, rows * tile_h
+    pitch = sheet_w * 4
+    sheet = bytearray(pitch * sheet_h)
+    frames = {}
+    for i, (x, y) in enumerate(cells):
+        left = (i % columns) * tile_w
+        top = (i // columns) * tile_h
+        bottom = sheet_h - top - tile_h
+        canvas.get_cells_bytes(x, y, 1, 1, sheet, pitch,
+                               bottom * pitch + left * 4)
+        frames["tile_%d_%d" % (x, y)] = {
+            "frame": {"x": left, "y": top, "w": tile_w, "h": tile_h}}
+
+    write_png(path, sheet_w, sheet_h, sheet)
+
+    if atlas_path:
+        atlas = {"frames": frames,
+                 "meta": {"image": os.path.basename(path),
+                          "size": {"w": sheet_w, "h": sheet_h},
+                          "unique_tiles": canvas.count_unique_tiles()}}
+        with open(atlas_path, "w") as atlas_file:
+            json.dump(atlas, atlas_file, indent=2, sort_keys=True)
@@ -0,0 +1,91 @@
+__author__ = 'cseebach'
+
+from instrument import stats
+
+class Change(object):
+    """
+    The tiles touched by one action, along with their state on the other side
+    of that action.
+
+    Applying a change swaps the stored tiles with the ones on the canvas, so
+    the same change object is used both to undo an action and to redo it.
+    """
+
+    def __init__(self, action, tiles):
+        self.action = action
+        self.tiles = tiles
+
+    def apply(self, canvas):
+        """
+        Swap the stored tile states with the current ones on the canvas.
+        """
+        swapped = []
+        #cells showing the same library tile share its pixels, so the state
+        #restored last must be the one saved first. Restoring in reverse order
+        #does that, and the swapped states are kept in the order they were
+        #taken, so the next swap goes the other way and the same holds
+        for (tile_x, tile_y), saved in reversed(self.tiles.items()):
+            swapped.append(((tile_x, tile_y),
+                            canvas.tiles[tile_y][tile_x].copy()))
+            canvas.restore_tile(tile_x, tile_y, saved)
+        self.tiles = type(self.tiles)(swapped)
+
+class History(object):
+    """
+    Undo and redo for actions performed on a canvas.
+
+    Instead of replaying every action since the start of the session, each
+    action is stored as a delta of the tiles it touched, so undoing or redoing
+    costs about as much as the action itself.
+    """
+
+    def __init__(self):
+        self.undo_stack = []
+        self.redo_stack = []
+
+    def do(self, action, canvas):
+        """
+        Run an action on the canvas, and remember how to take it back.
+        """
+        canvas.start_journal()
+        try:
+            with stats.timing("do " + type(action).__name__):
+                action.do(canvas)
+        finally:
+            touched = canvas.stop_journal()
+
+        if touched:
+            self.undo_stack.append(Change(action, touched))
+            del self.redo_stack[:]
+
+    def can_undo(self):
+        return bool(self.undo_stack)
+
+    def can_redo(self):
+        return bool(self.redo_stack)
+
+    def undo(self, canvas):
+        """
+        Take back the last action done to the canvas. Returns the action, or
+        None if there was nothing to undo.
+        """
+        if self.undo_stack:
+            change = self.undo_stack.pop()
+            stats.count("undo tiles", len(change.tiles))
+            with stats.timing("undo"):
+                change.apply(canvas)
+            self.redo_stack.append(change)
+            return change.action
+
+    def redo(self, canvas):
+        """
+        Do the last undone action again. Returns the action, or None if there
+        was nothing to redo.
+        """
+        if self.redo_stack:
+            change = self.redo_stack.pop()
+            stats.count("redo tiles", len(change.tiles))
+            with stats.timing("redo"):
+                change.apply(canvas)
+            self.undo_stack.append(change)
+            return change.action
@@ -0,0 +1,132 @@
+"""
+Counters and timings for the hot paths of Pixel Slammer, so a slow stroke can
+be pinned on rasterising, uploading or drawing:
+
+    with stats.timing("get_batch"):
+        ...
+    stats.count("upload bytes", num_bytes)
+    stats.end_frame()
+
+Totals are kept a frame at a time. The controller shows the last frame's over
+the canvas, and the kept frames can be dumped to a JSON or CSV trace.
+"""
+
+__author__ = 'cseebach'
+
+from collections import deque
+from contextlib import contextmanager
+import csv
+import functools
+import json
+from timeit import default_timer
+
+class Stats(object):
+    """
+    Counters and timings, gathered into one record per frame.
+
+    Timings are kept as the milliseconds spent under a name, along with the
+    number of calls, as "<name> ms" and "<name> calls". Only the last
+    frames_kept records are held on to.
+    """
+
+    frames_kept = 600
+
+    def __init__(self):
+        self.started = self.frame_started = default_timer()
+        self.frame_number = 0
+        self.current = {}
+        self.frames = deque(maxlen=self.frames_kept)
+
+    def count(self, name, amount=1):
+        self.current[name] = self.current.get(name, 0) + amount
+
+    def add_time(self, name, seconds):
+        self.count(name + " ms", seconds * 1000)
+        self.count(name + " calls")
+
+    @contextmanager
+    def timing(self, name):
+        """
+        Time the body of a with statement under a name.
+        """
+        start = default_timer()
+        try:
+            yield
+        finally:
+            self.add_time(name, default_timer() - start)
+
+    def timed(self, name):
+        """
+        A decorator that times every call of a function under a name.
+        """
+        def wrap(function):
+            @functools.wraps(function)
+            def wrapped(*args, **kwargs):
+                start = default_timer()
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    self.add_time(name, default_timer() - start)
+            return wrapped
+        return wrap
+
+    def end_frame(self):
+        """
+        Close the record of the frame that just ended, and start a new one.
+        Returns the closed record.
+        """
+        now = default_timer()
+        record = self.current
+        record["frame"] = self.frame_number
+        record["time"] = now - self.started
+        record["frame ms"] = (now - self.frame_started) * 1000
+        self.frames.append(record)
+
+        self.current = {}
+        self.frame_number += 1
+        self.frame_started = now
+        return record
+
+    def get_lines(self):
+        """
+        Returns lines of text describing the last frame, for showing over the
+        canvas.
+        """
+        if not self.frames:
+            return []
+        record = self.frames[-1]
+        lines = []
+        for name in sorted(record):
+            if name in ("frame", "time"):
+                continue
+            if name.endswith(" ms"):
+                lines.append("%s: %.2f" % (name, record[name]))
+            else:
+                lines.append("%s: %d" % (name, record[name]))
+        return lines
+
+    def get_columns(self):
+        names = set()
+        for record in self.frames:
+            names.update(record)
+        names.difference_update(("frame", "time"))
+        return ["frame", "time"] + sorted(names)
+
+    def dump_json(self, path):
+        """
+        Write the kept frames to a JSON file, as a list of records.
+        """
+        with open(path, "w") as trace_file:
+            json.dump(list(self.frames), trace_file, indent=2, sort_keys=True)
+
+    def dump_csv(self, path):
+        """
+        Write the kept frames to a CSV file, one row per frame. Anything not
+        counted in a frame is 0 in its row.
+        """
+        with open(path, "wb") as trace_file:
+            writer = csv.DictWriter(trace_file, self.get_columns(), restval=0)
+            writer.writeheader()
+            writer.writerows(self.frames)
+
+stats = Stats()
@@ -1,20 +1,77 @@
 __author__ = 'cseebach'
 
+from timeit import default_timer
+started = default_timer()
+
+import argparse
+import os
+
 import pyglet
 
 from controller import SlammerCtrl
 from model import SlammerModel
+from project import load_project
 from view import SlammerView
 
-def main():
+class StartupTimer(object):
+    """
+    Notes how long each step of starting up takes, up to the first frame the
+    canvas draws, and prints a report once that frame is done.
+    """
+
+    def __init__(self, started):
+        self.started = self.last = started
+        self.steps = []
+        self.done = False
+
+    def mark(self, step):
+        now = default_timer()
+        self.steps.append((step, now - self.last))
+        self.last = now
+
+    def on_canvas_draw(self):
+        if not self.done:
+            self.done = True
+            self.mark("first frame")
+            self.report()
+
+    def report(self):
+        for step, seconds in self.steps:
+            print "%-16s %8.1fms" % (step, seconds * 1000)
+        print "%-16s %8.1fms" % ("time to first frame",
+                                 (self.last - self.started) * 1000)
+
+def main(project_path="untitled.pslm", timing=False, indexed=False):
     """
-    Run the Pixel Slammer application
+    Run the Pixel Slammer application, opening the given project if it exists.
+    With timing set, a report of how long startup took is printed. With indexed
+    set, a new project stores its pixels as palette indices.
     """
-    model = SlammerModel()
+    timer = StartupTimer(started)
+    timer.mark("imports")
+
+    if os.path.exists(project_path):
+        model = load_project(project_path)
+    else:
+        model = SlammerModel(indexed=indexed)
+    timer.mark("model")
     view = SlammerView()
-    ctrl = SlammerCtrl(model, view)
+    timer.mark("view")
+    if timing:
+        #pushed before the controller's handlers, so it runs after they draw
+        view.canvas.push_handlers(timer)
+    ctrl = SlammerCtrl(model, view, project_path)
+    timer.mark("controller")
 
     pyglet.app.run()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Run Pixel Slammer.")
+    parser.add_argument("project", nargs="?", default="untitled.pslm",
+                        help="the project to open (default: untitled.pslm)")
+    parser.add_argument("--timing", action="store_true",
+                        help="print how long startup took")
+    parser.add_argument("--indexed", action="store_true",
+                        help="store a new project's pixels as palette indices")
+    options = parser.parse_args()
+    main(options.project, timing=options.timing, indexed=options.indexed)
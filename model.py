@@ -1,10 +1,23 @@
 __author__ = 'cseebach'
 
+from array import array
+from collections import Counter, OrderedDict
 import ctypes
+import hashlib
+from itertools import product
+import struct
+import weakref
 
 import pyglet
 from pyglet import gl
 
+from instrument import stats
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 def must_flush(to_wrap):
     def wrapped(self, *args, **kwargs):
         if self.dirty:
@@ -12,18 +25,350 @@ def must_flush(to_wrap):
         return to_wrap(self, *args, **kwargs)
     return wrapped
 
+class UploadCounter(object):
+    """
+    Keeps count of how many bytes of pixel data get sent to textures.
+    """
+
+    def __init__(self):
+        self.frame_bytes = 0
+        self.last_frame_bytes = 0
+        self.total_bytes = 0
+
+    def count(self, num_bytes):
+        self.frame_bytes += num_bytes
+        self.total_bytes += num_bytes
+
+    def end_frame(self):
+        """
+        Start counting a new frame. Returns the bytes uploaded during the frame
+        that just ended.
+        """
+        self.last_frame_bytes, self.frame_bytes = self.frame_bytes, 0
+        return self.last_frame_bytes
+
+uploads = UploadCounter()
+
+def pack_color(color):
+    """
+    Returns an RGBA color as one 32 bit number, with its bytes laid out in
+    memory the same way as a pixel's.
+    """
+    return struct.unpack("=I", str(bytearray(color)))[0]
+
+def unpack_color(packed):
+    return tuple(bytearray(struct.pack("=I", packed)))
+
+def update_counts(counts, removed, added):
+    """
+    Take the removed counts away from a dict of counts, and add the added ones.
+    Anything whose count drops to 0 is left out.
+    """
+    for key, count in removed.iteritems():
+        counts[key] -= count
+        if not counts[key]:
+            del counts[key]
+    for key, count in added.iteritems():
+        counts[key] = counts.get(key, 0) + count
+
+class Palette(list):
+    """
+    A list of RGB colors, shown in the toolbox and shared by the pixels of an
+    indexed canvas. It holds at most 255 colors that pixels can use.
+
+    Pixel index 0 is transparent, and any other index is the entry before it,
+    fully opaque. Changing an entry changes the palette's version, and throws
+    away the lookups made from it.
+    """
+
+    def __init__(self, colors=()):
+        super(Palette, self).__init__(colors)
+        self.version = 0
+        self.table = None
+        self.indices = {}
+
+    def __setitem__(self, index, color):
+        super(Palette, self).__setitem__(index, color)
+        self.changed()
+
+    def __setslice__(self, start, end, colors):
+        super(Palette, self).__setslice__(start, end, colors)
+        self.changed()
+
+    def append(self, color):
+        super(Palette, self).append(color)
+        self.changed()
+
+    def extend(self, colors):
+        super(Palette, self).extend(colors)
+        self.changed()
+
+    def changed(self):
+        self.version += 1
+        self.table = None
+        self.indices = {}
+
+    def get_color(self, index):
+        """
+        Returns the RGBA color of a pixel index.
+        """
+        if not index:
+            return (0, 0, 0, 0)
+        return tuple(int(c) for c in self[index - 1][:3]) + (255,)
+
+    def get_index(self, color):
+        """
+        Returns the pixel index an RGBA color is stored as. Transparent colors
+        are index 0, and any other color is stored as the closest entry.
+        """
+        if not color[3]:
+            return 0
+        rgb = tuple(color[:3])
+        if rgb not in self.indices:
+            distances = [sum((a - b) ** 2 for a, b in zip(entry, rgb))
+                         for entry in self[:255]]
+            self.indices[rgb] = distances.index(min(distances)) + 1
+        return self.indices[rgb]
+
+    def get_table(self):
+        """
+        Returns an array of 256 packed RGBA colors, the color of each pixel
+        index.
+        """
+        if self.table is None:
+            used = min(len(self), 255) + 1
+            self.table = array("I", [pack_color(self.get_color(index))
+                                     for index in xrange(used)])
+            self.table.extend([0] * (256 - used))
+        return self.table
+
+def orient_corners(rotation=0, flip_x=False, flip_y=False):
+    """
+    Returns which corner of the stored pixels is shown at each corner of an
+    area with the given transforms, in the order bottom left, bottom right, top
+    right, top left. Corners are numbered in that same order.
+
+    The transforms are applied the same way pyglet's Texture.get_transform
+    applies them to textures.
+    """
+    bl, br, tr, tl = 0, 1, 2, 3
+    if flip_x:
+        bl, br, tl, tr = br, bl, tr, tl
+    if flip_y:
+        bl, br, tl, tr = tl, tr, bl, br
+    rotation %= 360
+    if rotation == 90:
+        bl, br, tr, tl = br, tr, tl, bl
+    elif rotation == 180:
+        bl, br, tr, tl = tr, tl, bl, br
+    elif rotation == 270:
+        bl, br, tr, tl = tl, bl, br, tr
+    return bl, br, tr, tl
+
+def orientation_map(width, height, rotation=0, flip_x=False, flip_y=False):
+    """
+    Returns a list with an entry for each pixel of a width by height area as it
+    is shown with the given transforms, in rows starting from the bottom: the
+    index of the stored pixel shown there.
+
+    The transforms are applied the same way pyglet's Texture.get_transform
+    applies them to textures, so this matches what is drawn.
+    """
+    bl, br, tr, tl = orient_corners(rotation, flip_x, flip_y)
+    rotation %= 360
+    if rotation in (90, 270):
+        shown_w, shown_h = height, width
+    else:
+        shown_w, shown_h = width, height
+
+    corners = [(0, 0), (1, 0), (1, 1), (0, 1)]
+    (origin_x, origin_y), right, up = corners[bl], corners[br], corners[tl]
+    step_x = (right[0] - origin_x, right[1] - origin_y)
+    step_y = (up[0] - origin_x, up[1] - origin_y)
+    start_x, start_y = origin_x * (width - 1), origin_y * (height - 1)
+
+    mapping = []
+    for y in xrange(shown_h):
+        for x in xrange(shown_w):
+            stored_x = start_x + step_x[0] * x + step_y[0] * y
+            stored_y = start_y + step_x[1] * x + step_y[1] * y
+            mapping.append(stored_y * width + stored_x)
+    return mapping
+
+#orientation maps, and their inverses, by size and orientation
+orientation_maps = {}
+
+def get_orientation_maps(width, height, rotation=0, flip_x=False,
+                         flip_y=False):
+    """
+    Returns the orientation_map of an area with the given transforms, and its
+    inverse: for each stored pixel, the index of the place it is shown. The
+    maps are only made once for each size and orientation, and are shared
+    from then on, so they must not be changed.
+    """
+    key = width, height, rotation % 360, bool(flip_x), bool(flip_y)
+    if key not in orientation_maps:
+        mapping = orientation_map(*key)
+        inverse = [0] * len(mapping)
+        for shown, stored in enumerate(mapping):
+            inverse[stored] = shown
+        orientation_maps[key] = mapping, inverse
+    return orientation_maps[key]
+
+def orient_pixels(data, mapping, pixel_size=4):
+    """
+    Rearrange a string of pixels, each pixel_size bytes long, through a
+    mapping made by orientation_map.
+    """
+    if numpy is not None:
+        dtype = numpy.uint32 if pixel_size == 4 else numpy.uint8
+        return numpy.frombuffer(data, dtype=dtype)[mapping].tostring()
+    pixels = array("I" if pixel_size == 4 else "B", data)
+    return array(pixels.typecode, [pixels[i] for i in mapping]).tostring()
+
 class PixelArea(pyglet.image.ImageData):
     """
     Represents a drawing surface with pixel access.
     """
 
-    def __init__(self, width, height, data=None):
-        #noinspection PyCallingNonCallable,PyTypeChecker
-        self.ctypes_data = (ctypes.c_ubyte * (width * height * 4))()
+    def __init__(self, width, height, data=None, ctypes_data=None):
+        """
+        Create a new, blank area. The pixels can be set from a sequence of
+        bytes with data, or an existing ctypes array can be passed as
+        ctypes_data to be used as the pixel buffer without copying it.
+        """
+        if ctypes_data is None:
+            #noinspection PyCallingNonCallable,PyTypeChecker
+            ctypes_data = (ctypes.c_ubyte * (width * height * 4))()
+        self.ctypes_data = ctypes_data
         if data:
             self.ctypes_data[:] = data
         super(PixelArea, self).__init__(width, height, "RGBA", ctypes.pointer(self.ctypes_data))
         self.dirty = False
+        self.dirty_rect = None
+        self.version = 0
+        self.color_counts = None
+        #how many areas use ctypes_data, shared between all of them
+        self.sharers = [1]
+        #takes this area off the count of sharers when it is thrown away
+        self.sharer_ref = None
+        #where this area's pixels are kept in a canvas's texture atlas
+        self.atlas_region = None
+
+    def mark_dirty(self, x=0, y=0, width=None, height=None):
+        """
+        Note that the pixels in the given rectangle have changed, and need to be
+        flushed before they are next displayed. By default, the whole area is
+        marked.
+        """
+        if width is None:
+            width = self.width
+        if height is None:
+            height = self.height
+        if self.dirty_rect:
+            x0, y0, x1, y1 = self.dirty_rect
+            self.dirty_rect = (min(x0, x), min(y0, y),
+                               max(x1, x + width), max(y1, y + height))
+        else:
+            self.dirty_rect = (x, y, x + width, y + height)
+        self.dirty = True
+        self.version += 1
+
+    def mark_changed(self, x=0, y=0, width=None, height=None):
+        """
+        Like mark_dirty, but for pixels changed from outside of this class, for
+        example through the array: the color counts are recounted when next
+        asked for.
+        """
+        self.color_counts = None
+        self.mark_dirty(x, y, width, height)
+
+    def watch_sharers(self):
+        """
+        Make sure this area comes off the count of areas sharing its pixels
+        once it is thrown away, so that the last one left can write to them
+        without copying them.
+        """
+        if self.sharer_ref is None:
+            sharers = self.sharers
+            def release(ref):
+                sharers[0] -= 1
+            self.sharer_ref = weakref.ref(self, release)
+
+    def use_buffer(self, ctypes_data, sharers):
+        self.sharers[0] -= 1
+        self.ctypes_data = ctypes_data
+        self.sharers = sharers
+        self.sharers[0] += 1
+        #dropping the old reference drops its callback along with it
+        self.sharer_ref = None
+        self.watch_sharers()
+        if self._current_data is not None:
+            self._current_data = ctypes.pointer(ctypes_data)
+
+    def share(self, other):
+        """
+        Use the same pixel buffer as another area of the same size, instead of
+        copying its pixels. The buffer is only copied once one of the areas
+        sharing it is written to.
+        """
+        if other.sharers is not self.sharers:
+            other.watch_sharers()
+            self.use_buffer(other.ctypes_data, other.sharers)
+
+    def unshare(self):
+        """
+        Give this area a pixel buffer of its own, if it is sharing one. Called
+        before any change to the pixels.
+        """
+        if self.sharers[0] > 1:
+            #noinspection PyCallingNonCallable,PyTypeChecker
+            ctypes_data = (ctypes.c_ubyte * len(self.ctypes_data))()
+            ctypes.memmove(ctypes_data, self.ctypes_data, len(ctypes_data))
+            self.use_buffer(ctypes_data, [0])
+
+    def get_color_counts(self):
+        """
+        Returns a dict from each color in this area to the number of pixels of
+        that color. Colors are RGBA tuples.
+
+        The counts are only made the first time they are asked for. After that
+        they are kept up to date as pixels are changed.
+        """
+        if self.color_counts is None:
+            self.color_counts = self.count_colors(0, 0, self.width, self.height)
+        return self.color_counts
+
+    def count_colors(self, x, y, width, height):
+        """
+        Count the colors of the pixels in a rectangle, which must lie inside
+        this area.
+        """
+        if not width or not height:
+            return Counter()
+        if numpy is not None:
+            region = numpy.ascontiguousarray(
+                self.read_array()[y:y+height, x:x+width])
+            values, counts = numpy.unique(region.view(numpy.uint32),
+                                          return_counts=True)
+            return Counter(dict((unpack_color(value), count) for value, count
+                                in zip(values.tolist(), counts.tolist())))
+
+        pixels = array("I")
+        pitch = self.width * 4
+        address = ctypes.addressof(self.ctypes_data) + y * pitch + x * 4
+        for i in xrange(height):
+            pixels.fromstring(ctypes.string_at(address + i * pitch, width * 4))
+        return Counter(dict((unpack_color(value), count) for value, count
+                            in Counter(pixels).iteritems()))
+
+    def update_color_counts(self, removed, added):
+        """
+        Take the removed counts away from the color counts, and add the added
+        ones, if the color counts are being kept.
+        """
+        if self.color_counts is not None:
+            update_counts(self.color_counts, removed, added)
 
     def get_pixel(self, x, y):
         """
@@ -41,17 +386,49 @@ class PixelArea(pyglet.image.ImageData):
 
         Each color component must be between 0 and 255.
         """
+        self.unshare()
         pitch = self.width * 4
         offset = (y * pitch) + x * 4
+        if self.color_counts is not None:
+            self.update_color_counts(
+                {tuple(self.ctypes_data[offset:offset+4]): 1},
+                {tuple(color): 1})
         self.ctypes_data[offset:offset+4] = color
-        self.dirty = True
+        self.mark_dirty(x, y, 1, 1)
 
+    @stats.timed("flush_changes")
     def flush_changes(self):
         """
         Changes made with set_pixel are not actually seen until this method is called.
+
+        Once this area has a texture, or a region of a texture atlas, only the
+        rectangle around the pixels that changed is uploaded to it.
         """
-        self.set_data("RGBA", self.width * 4, ctypes.pointer(self.ctypes_data))
+        texture = self._current_texture
+        if texture is None:
+            self.set_data("RGBA", self.width * 4, ctypes.pointer(self.ctypes_data))
+        elif self.dirty_rect:
+            self.upload_rect(texture, *self.dirty_rect)
+        if self.atlas_region is not None and self.dirty_rect:
+            self.upload_rect(self.atlas_region, *self.dirty_rect)
         self.dirty = False
+        self.dirty_rect = None
+
+    def upload_rect(self, texture, x0, y0, x1, y1):
+        """
+        Copy one rectangle of pixels into the matching place in a texture.
+        """
+        gl.glBindTexture(texture.target, texture.id)
+        gl.glPushClientAttrib(gl.GL_CLIENT_PIXEL_STORE_BIT)
+        gl.glPixelStorei(gl.GL_UNPACK_ALIGNMENT, 1)
+        gl.glPixelStorei(gl.GL_UNPACK_ROW_LENGTH, self.width)
+        gl.glPixelStorei(gl.GL_UNPACK_SKIP_PIXELS, x0)
+        gl.glPixelStorei(gl.GL_UNPACK_SKIP_ROWS, y0)
+        gl.glTexSubImage2D(texture.target, texture.level,
+                           texture.x + x0, texture.y + y0, x1 - x0, y1 - y0,
+                           gl.GL_RGBA, gl.GL_UNSIGNED_BYTE, self.ctypes_data)
+        gl.glPopClientAttrib()
+        uploads.count((x1 - x0) * (y1 - y0) * 4)
 
     @must_flush
     def blit_to_texture(self, target, level, x, y, z, internalformat=None):
@@ -71,6 +448,7 @@ class PixelArea(pyglet.image.ImageData):
 
     @must_flush
     def create_texture(self, cls, rectangle=False, force_rectangle=False):
+        uploads.count(self.width * self.height * 4)
         return super(PixelArea, self).create_texture(cls, rectangle, force_rectangle)
 
     @must_flush
@@ -90,46 +468,581 @@ class PixelArea(pyglet.image.ImageData):
         return super(PixelArea, self).get_region(x, y, width, height)
 
     def copy(self):
-        return PixelArea(self.width, self.height, data=self.ctypes_data)
+        """
+        Returns a copy of this area, which shares its pixels until one of them
+        is written to.
+        """
+        copy = PixelArea(self.width, self.height, ctypes_data=self.ctypes_data)
+        copy.restore(self)
+        return copy
+
+    def get_rgba(self, x=0, y=0, width=None, height=None):
+        """
+        Returns the RGBA bytes of a rectangle of pixels, by default the whole
+        area, as a string of rows starting with the bottom one.
+        """
+        if width is None:
+            width = self.width - x
+        if height is None:
+            height = self.height - y
+        if (x, y, width, height) == (0, 0, self.width, self.height):
+            return ctypes.string_at(self.ctypes_data, len(self.ctypes_data))
+
+        pitch = self.width * 4
+        address = ctypes.addressof(self.ctypes_data) + y * pitch + x * 4
+        return "".join(ctypes.string_at(address + i * pitch, width * 4)
+                       for i in xrange(height))
 
     def save(self, *args, **kwargs):
-        self.set_data("RGBA", self.width * 4, "".join(chr(i) for i in self.ctypes_data))
-        super(PixelArea, self).save(*args, **kwargs)
-        self.flush_changes()
+        """
+        Save the pixels as an image, through pyglet's encoders. The pixels are
+        copied out in one go, so the texture is left alone.
+        """
+        image = pyglet.image.ImageData(self.width, self.height, "RGBA",
+                                       self.get_rgba())
+        image.save(*args, **kwargs)
 
     def erase(self):
-        for i in xrange(len(self.ctypes_data)):
-            self.ctypes_data[i] = 0
-        self.dirty = True
+        self.unshare()
+        ctypes.memset(self.ctypes_data, 0, len(self.ctypes_data))
+        self.color_counts = Counter({(0, 0, 0, 0): self.width * self.height})
+        self.mark_dirty()
+
+    def set_rgba(self, data):
+        """
+        Set every pixel at once from a string of RGBA rows, starting with the
+        bottom row, like the ones get_rgba returns.
+        """
+        data = str(data)
+        if len(data) != self.width * self.height * 4:
+            raise ValueError("expected %d bytes of pixels, got %d" %
+                             (self.width * self.height * 4, len(data)))
+        self.unshare()
+        ctypes.memmove(self.ctypes_data, data, len(data))
+        self.mark_changed()
+
+    @property
+    def array(self):
+        """
+        The pixels as a NumPy array of bytes. This is a view of the same memory
+        the texture is made from, not a copy, so call mark_changed after
+        writing to it. If the pixels were shared, this area gets its own first.
+        """
+        self.unshare()
+        return self.read_array()
+
+    def read_array(self):
+        """
+        Returns the pixels as a (height, width, 4) NumPy array view, which must
+        only be read from, since the pixels may be shared.
+        """
+        if numpy is None:
+            raise ImportError("NumPy is needed for array access to pixels")
+        return numpy.ctypeslib.as_array(self.ctypes_data).reshape(
+            self.height, self.width, 4)
+
+    def clip_rect(self, x, y, width, height):
+        """
+        Returns the part of a rectangle that lies inside this area, as
+        x, y, width, height. The width and height may be 0.
+        """
+        x0, y0 = max(x, 0), max(y, 0)
+        x1, y1 = min(x + width, self.width), min(y + height, self.height)
+        return x0, y0, max(x1 - x0, 0), max(y1 - y0, 0)
+
+    def fill_rect(self, x, y, width, height, color):
+        """
+        Set every pixel in a rectangle to one color. The parts of the rectangle
+        outside this area are ignored.
+        """
+        x, y, width, height = self.clip_rect(x, y, width, height)
+        if not width or not height:
+            return
+
+        self.unshare()
+        if self.color_counts is not None:
+            self.update_color_counts(self.count_colors(x, y, width, height),
+                                     {tuple(color): width * height})
+        if numpy is not None:
+            self.array[y:y+height, x:x+width] = color
+        else:
+            row = str(bytearray(color)) * width
+            pitch = self.width * 4
+            address = ctypes.addressof(self.ctypes_data) + y * pitch + x * 4
+            for i in xrange(height):
+                ctypes.memmove(address + i * pitch, row, len(row))
+        self.mark_dirty(x, y, width, height)
+
+    def copy_rect(self, source, x, y, source_x=0, source_y=0, width=None,
+                  height=None):
+        """
+        Copy a rectangle of pixels from another area into this one, placing its
+        bottom left corner at x, y. By default, all of the source is copied.
+        Parts that would land outside this area are ignored.
+        """
+        if width is None:
+            width = source.width - source_x
+        if height is None:
+            height = source.height - source_y
+
+        dest_x, dest_y, width, height = self.clip_rect(x, y, width, height)
+        source_x += dest_x - x
+        source_y += dest_y - y
+        if not width or not height:
+            return
+
+        self.unshare()
+        if self.color_counts is not None:
+            removed = self.count_colors(dest_x, dest_y, width, height)
+        if numpy is not None:
+            self.array[dest_y:dest_y+height, dest_x:dest_x+width] = \
+                source.read_array()[source_y:source_y+height,
+                                    source_x:source_x+width]
+        else:
+            pitch, source_pitch = self.width * 4, source.width * 4
+            address = (ctypes.addressof(self.ctypes_data) + dest_y * pitch +
+                       dest_x * 4)
+            source_address = (ctypes.addressof(source.ctypes_data) +
+                              source_y * source_pitch + source_x * 4)
+            for i in xrange(height):
+                ctypes.memmove(address + i * pitch,
+                               source_address + i * source_pitch, width * 4)
+        if self.color_counts is not None:
+            self.update_color_counts(
+                removed, self.count_colors(dest_x, dest_y, width, height))
+        self.mark_dirty(dest_x, dest_y, width, height)
+
+    def replace_color(self, old_color, new_color):
+        """
+        Change every pixel of one color to another color. Returns how many
+        pixels were changed.
+        """
+        return self.remap_colors({tuple(old_color): tuple(new_color)})
+
+    def remap_colors(self, table):
+        """
+        Change the colors of every pixel in one pass, through a dict from old
+        colors to new ones. Colors not in the table are left alone. Each pixel
+        is looked up by the color it had before the remap, so colors can be
+        swapped with each other. Returns how many pixels were changed.
+        """
+        counts = self.get_color_counts()
+        table = dict((tuple(old), tuple(new)) for old, new in table.iteritems()
+                     if tuple(old) != tuple(new) and tuple(old) in counts)
+        if not table:
+            return 0
+
+        removed = dict((old, counts[old]) for old in table)
+        added = Counter()
+        for old, new in table.iteritems():
+            added[new] += counts[old]
+
+        packed_table = dict((pack_color(old), pack_color(new))
+                            for old, new in table.iteritems())
+        self.unshare()
+        if numpy is not None:
+            packed = numpy.ctypeslib.as_array(self.ctypes_data).view(numpy.uint32)
+            if len(packed_table) == 1:
+                (old, new), = packed_table.items()
+                packed[packed == old] = new
+            else:
+                olds = numpy.array(sorted(packed_table), dtype=numpy.uint32)
+                news = numpy.array([packed_table[old] for old in olds.tolist()],
+                                   dtype=numpy.uint32)
+                places = numpy.minimum(numpy.searchsorted(olds, packed),
+                                       len(olds) - 1)
+                matched = olds[places] == packed
+                packed[matched] = news[places[matched]]
+        else:
+            pixels = array("I")
+            pixels.fromstring(ctypes.string_at(self.ctypes_data,
+                                               len(self.ctypes_data)))
+            lookup = packed_table.get
+            pixels = array("I", [lookup(value, value) for value in pixels])
+            ctypes.memmove(self.ctypes_data, pixels.tostring(),
+                           len(self.ctypes_data))
+
+        self.update_color_counts(removed, added)
+        self.mark_dirty()
+        return sum(removed.itervalues())
+
+    def restore(self, other):
+        """
+        Give this area the pixels of another area of the same size, keeping
+        this area's identity (and its texture). The two share the pixels until
+        one of them is written to.
+        """
+        self.share(other)
+        if other.color_counts is None:
+            self.color_counts = None
+        else:
+            self.color_counts = Counter(other.color_counts)
+        self.mark_dirty()
+
+class IndexedPixelArea(PixelArea):
+    """
+    A drawing surface that stores each pixel as a one byte index into a shared
+    palette, instead of as four bytes of RGBA.
+
+    Pixels are still read and written as RGBA colors, through the palette. The
+    RGBA pixels a texture needs are only looked up when they are uploaded, so
+    changing a palette entry recolors every area using it without touching
+    their pixels.
+    """
+
+    def __init__(self, width, height, palette, data=None, ctypes_data=None):
+        if ctypes_data is None:
+            #noinspection PyCallingNonCallable,PyTypeChecker
+            ctypes_data = (ctypes.c_ubyte * (width * height))()
+        self.palette = palette
+        self.index_counts = None
+        super(IndexedPixelArea, self).__init__(width, height, data, ctypes_data)
+        #the RGBA pixels only exist while they are being sent to a texture
+        self._current_data = None
+
+    def mark_changed(self, x=0, y=0, width=None, height=None):
+        self.index_counts = None
+        self.mark_dirty(x, y, width, height)
+
+    def get_index_counts(self):
+        """
+        Returns a dict from each pixel index in this area to the number of
+        pixels with that index, kept up to date once it has been made.
+        """
+        if self.index_counts is None:
+            self.index_counts = self.count_indices(0, 0, self.width,
+                                                   self.height)
+        return self.index_counts
+
+    def count_indices(self, x, y, width, height):
+        if not width or not height:
+            return Counter()
+        if numpy is not None:
+            counts = numpy.bincount(
+                self.read_array()[y:y+height, x:x+width].ravel(), minlength=256)
+            return Counter(dict((index, count) for index, count
+                                in enumerate(counts.tolist()) if count))
+
+        counts = Counter()
+        address = ctypes.addressof(self.ctypes_data) + y * self.width + x
+        for i in xrange(height):
+            counts.update(bytearray(ctypes.string_at(address + i * self.width,
+                                                     width)))
+        return counts
+
+    def get_color_counts(self):
+        counts = Counter()
+        for index, count in self.get_index_counts().iteritems():
+            counts[self.palette.get_color(index)] += count
+        return counts
+
+    def count_colors(self, x, y, width, height):
+        counts = Counter()
+        for index, count in self.count_indices(x, y, width,
+                                               height).iteritems():
+            counts[self.palette.get_color(index)] += count
+        return counts
+
+    def get_pixel(self, x, y):
+        return list(self.palette.get_color(self.ctypes_data[y * self.width + x]))
+
+    def set_pixel(self, x, y, color):
+        self.unshare()
+        offset = y * self.width + x
+        index = self.palette.get_index(color)
+        if self.index_counts is not None:
+            update_counts(self.index_counts, {self.ctypes_data[offset]: 1},
+                          {index: 1})
+        self.ctypes_data[offset] = index
+        self.mark_dirty(x, y, 1, 1)
+
+    def palette_changed(self, entry):
+        """
+        Must be called after a palette entry is changed, so that this area is
+        uploaded again if it uses that entry. Returns whether it does.
+        """
+        if entry + 1 in self.get_index_counts():
+            self.mark_dirty()
+            return True
+        return False
+
+    def get_rgba(self, x=0, y=0, width=None, height=None):
+        if width is None:
+            width = self.width - x
+        if height is None:
+            height = self.height - y
+
+        table = self.palette.get_table()
+        if numpy is not None:
+            table = numpy.frombuffer(table, dtype=numpy.uint32)
+            return table[self.read_array()[y:y+height, x:x+width]].tostring()
+
+        pixels = array("I")
+        address = ctypes.addressof(self.ctypes_data) + y * self.width + x
+        for i in xrange(height):
+            row = ctypes.string_at(address + i * self.width, width)
+            pixels.extend([table[index] for index in bytearray(row)])
+        return pixels.tostring()
+
+    @stats.timed("flush_changes")
+    def flush_changes(self):
+        """
+        Once this area has a texture, or a region of a texture atlas, the
+        rectangle around the pixels that changed is looked up in the palette
+        and uploaded to it. Before then, there is nothing to do.
+        """
+        texture = self._current_texture
+        if texture is not None and self.dirty_rect:
+            self.upload_rect(texture, *self.dirty_rect)
+        if self.atlas_region is not None and self.dirty_rect:
+            self.upload_rect(self.atlas_region, *self.dirty_rect)
+        self.dirty = False
+        self.dirty_rect = None
+
+    def upload_rect(self, texture, x0, y0, x1, y1):
+        pixels = self.get_rgba(x0, y0, x1 - x0, y1 - y0)
+        gl.glBindTexture(texture.target, texture.id)
+        gl.glPushClientAttrib(gl.GL_CLIENT_PIXEL_STORE_BIT)
+        gl.glPixelStorei(gl.GL_UNPACK_ALIGNMENT, 1)
+        gl.glPixelStorei(gl.GL_UNPACK_ROW_LENGTH, 0)
+        gl.glPixelStorei(gl.GL_UNPACK_SKIP_PIXELS, 0)
+        gl.glPixelStorei(gl.GL_UNPACK_SKIP_ROWS, 0)
+        gl.glTexSubImage2D(texture.target, texture.level,
+                           texture.x + x0, texture.y + y0, x1 - x0, y1 - y0,
+                           gl.GL_RGBA, gl.GL_UNSIGNED_BYTE, pixels)
+        gl.glPopClientAttrib()
+        uploads.count(len(pixels))
+
+    def blit_to_texture(self, target, level, x, y, z, internalformat=None):
+        self._current_data = self.get_rgba()
+        try:
+            super(IndexedPixelArea, self).blit_to_texture(target, level, x, y,
+                                                          z, internalformat)
+        finally:
+            self._current_data = None
+
+    def get_data(self, format, pitch):
+        image = pyglet.image.ImageData(self.width, self.height, "RGBA",
+                                       self.get_rgba())
+        return image.get_data(format, pitch)
+
+    def get_region(self, x, y, width, height):
+        return pyglet.image.ImageData(width, height, "RGBA",
+                                      self.get_rgba(x, y, width, height))
+
+    def copy(self):
+        copy = IndexedPixelArea(self.width, self.height, self.palette,
+                                ctypes_data=self.ctypes_data)
+        copy.restore(self)
+        return copy
+
+    def erase(self):
+        self.unshare()
+        ctypes.memset(self.ctypes_data, 0, len(self.ctypes_data))
+        self.index_counts = Counter({0: self.width * self.height})
+        self.mark_dirty()
+
+    def set_rgba(self, data):
+        """
+        Set every pixel at once from RGBA rows, storing each color as its
+        closest palette index.
+        """
+        data = str(data)
+        if len(data) != self.width * self.height * 4:
+            raise ValueError("expected %d bytes of pixels, got %d" %
+                             (self.width * self.height * 4, len(data)))
+        get_index = self.palette.get_index
+        if numpy is not None:
+            values, places = numpy.unique(
+                numpy.frombuffer(data, dtype=numpy.uint32), return_inverse=True)
+            lookup = numpy.array([get_index(unpack_color(value))
+                                  for value in values.tolist()],
+                                 dtype=numpy.uint8)
+            indices = lookup[places].tostring()
+        else:
+            lookup = {}
+            indices = bytearray(self.width * self.height)
+            for i, value in enumerate(array("I", data)):
+                if value not in lookup:
+                    lookup[value] = get_index(unpack_color(value))
+                indices[i] = lookup[value]
+            indices = str(indices)
+        self.unshare()
+        ctypes.memmove(self.ctypes_data, indices, len(indices))
+        self.mark_changed()
+
+    def read_array(self):
+        """
+        Returns the pixel indices as a (height, width) NumPy array view, which
+        must only be read from.
+        """
+        if numpy is None:
+            raise ImportError("NumPy is needed for array access to pixels")
+        return numpy.ctypeslib.as_array(self.ctypes_data).reshape(
+            self.height, self.width)
+
+    def fill_rect(self, x, y, width, height, color):
+        x, y, width, height = self.clip_rect(x, y, width, height)
+        if not width or not height:
+            return
+
+        index = self.palette.get_index(color)
+        self.unshare()
+        if self.index_counts is not None:
+            update_counts(self.index_counts,
+                          self.count_indices(x, y, width, height),
+                          {index: width * height})
+        if numpy is not None:
+            self.array[y:y+height, x:x+width] = index
+        else:
+            address = ctypes.addressof(self.ctypes_data) + y * self.width + x
+            for i in xrange(height):
+                ctypes.memset(address + i * self.width, index, width)
+        self.mark_dirty(x, y, width, height)
+
+    def copy_rect(self, source, x, y, source_x=0, source_y=0, width=None,
+                  height=None):
+        """
+        Copy a rectangle of pixels from another area into this one. Indices are
+        copied straight across from an area with the same palette; the colors
+        of any other area are matched to this area's palette.
+        """
+        if width is None:
+            width = source.width - source_x
+        if height is None:
+            height = source.height - source_y
+
+        dest_x, dest_y, width, height = self.clip_rect(x, y, width, height)
+        source_x += dest_x - x
+        source_y += dest_y - y
+        if not width or not height:
+            return
+
+        if getattr(source, "palette", None) is not self.palette:
+            for i in xrange(height):
+                for j in xrange(width):
+                    self.set_pixel(dest_x + j, dest_y + i,
+                                   source.get_pixel(source_x + j, source_y + i))
+            return
+
+        self.unshare()
+        if self.index_counts is not None:
+            removed = self.count_indices(dest_x, dest_y, width, height)
+        address = (ctypes.addressof(self.ctypes_data) + dest_y * self.width +
+                   dest_x)
+        source_address = (ctypes.addressof(source.ctypes_data) +
+                          source_y * source.width + source_x)
+        for i in xrange(height):
+            ctypes.memmove(address + i * self.width,
+                           source_address + i * source.width, width)
+        if self.index_counts is not None:
+            update_counts(self.index_counts, removed,
+                          self.count_indices(dest_x, dest_y, width, height))
+        self.mark_dirty(dest_x, dest_y, width, height)
+
+    def remap_colors(self, table):
+        """
+        Change the colors of every pixel in one pass, as PixelArea.remap_colors
+        does. The new colors are matched to the palette, and the remap is done
+        on the indices, through a table of 256 bytes.
+        """
+        counts = self.get_index_counts()
+        lookup = bytearray(xrange(256))
+        for old, new in table.iteritems():
+            old = tuple(old)
+            for index in counts:
+                if self.palette.get_color(index) == old:
+                    lookup[index] = self.palette.get_index(new)
+
+        removed = dict((index, count) for index, count in counts.iteritems()
+                       if lookup[index] != index)
+        if not removed:
+            return 0
+        added = Counter()
+        for index, count in removed.iteritems():
+            added[lookup[index]] += count
+
+        self.unshare()
+        if numpy is not None:
+            indices = numpy.ctypeslib.as_array(self.ctypes_data)
+            indices[:] = numpy.frombuffer(str(lookup), dtype=numpy.uint8)[indices]
+        else:
+            data = ctypes.string_at(self.ctypes_data, len(self.ctypes_data))
+            ctypes.memmove(self.ctypes_data, data.translate(str(lookup)),
+                           len(self.ctypes_data))
+
+        update_counts(counts, removed, added)
+        self.mark_dirty()
+        return sum(removed.itervalues())
+
+    def restore(self, other):
+        self.share(other)
+        if other.index_counts is None:
+            self.index_counts = None
+        else:
+            self.index_counts = Counter(other.index_counts)
+        self.mark_dirty()
 
 class Tile(object):
 
-    def __init__(self, width, height):
-        self.pixel_area = PixelArea(width, height)
+    def __init__(self, width, height, pixel_area=None):
+        self.pixel_area = pixel_area or PixelArea(width, height)
+        #the id of the library tile this shows, when it is on a canvas
+        self.tile_id = None
         self.rotation = 0
         self.flip_x = False
         self.flip_y = False
 
-    def flip_x(self):
+    def toggle_flip_x(self):
         self.flip_x = not self.flip_x
 
-    def flip_y(self):
+    def toggle_flip_y(self):
         self.flip_y = not self.flip_y
 
-    def transform_coords(self, x, y):
-        if self.flip_x:
-            x = self.pixel_area.width - x
-        if self.flip_y:
-            y = self.pixel_area.height - y
+    def rotate(self, degrees=90):
+        """
+        Turn this tile clockwise, by a multiple of 90 degrees.
+        """
+        self.rotation = (self.rotation + degrees) % 360
+
+    def is_transformed(self):
+        return bool(self.rotation % 360 or self.flip_x or self.flip_y)
+
+    def get_orientation_maps(self):
+        """
+        Returns the maps between the places pixels are shown at with this
+        tile's transforms and where they are stored, as get_orientation_maps
+        does.
+        """
+        area = self.pixel_area
+        return get_orientation_maps(area.width, area.height, self.rotation,
+                                    self.flip_x, self.flip_y)
 
-        to_rotate = self.rotation
-        while to_rotate > 0:
-            x, y = y, x
-            y = -y
-            y += self.pixel_area.height
-            to_rotate -= 90
+    def get_shown_size(self):
+        """
+        Returns the width and height of this tile as it is shown, which are
+        swapped when it is turned on its side.
+        """
+        area = self.pixel_area
+        if self.rotation % 180:
+            return area.height, area.width
+        return area.width, area.height
 
-        return x, y
+    def transform_coords(self, x, y):
+        """
+        Returns where the pixel shown at (x, y), with this tile's transforms,
+        is stored in the pixel area. Raises IndexError for a point that isn't
+        on the tile.
+        """
+        shown_w, shown_h = self.get_shown_size()
+        if not (0 <= x < shown_w and 0 <= y < shown_h):
+            raise IndexError("(%d, %d) is not on a %dx%d tile" %
+                             (x, y, shown_w, shown_h))
+        if not self.is_transformed():
+            return x, y
+        area = self.pixel_area
+        stored = self.get_orientation_maps()[0][y * shown_w + x]
+        return stored % area.width, stored // area.width
 
     def set_pixel(self, x, y, color):
         real_x, real_y = self.transform_coords(x, y)
@@ -138,81 +1051,752 @@ class Tile(object):
     def get_pixel(self, x, y):
         return self.pixel_area.get_pixel(*self.transform_coords(x, y))
 
-    def get_transformed(self):
-        texture = self.pixel_area.get_texture()
-        return texture.get_transform(flip_x=self.flip_x, flip_y=self.flip_y,
-                                     rotate=self.rotation)
+    def fill_rect(self, x, y, width, height, color):
+        """
+        Set every pixel in a rectangle, given in transformed coordinates, to one
+        color. The parts of the rectangle off the tile are ignored.
+        """
+        if not self.is_transformed():
+            self.pixel_area.fill_rect(x, y, width, height, color)
+            return
+        shown_w, shown_h = self.get_shown_size()
+        x0, y0 = max(x, 0), max(y, 0)
+        x1, y1 = min(x + width, shown_w), min(y + height, shown_h)
+        if x1 <= x0 or y1 <= y0:
+            return
+
+        #every transform turns a rectangle into another rectangle, with the
+        #opposite corners still opposite
+        stored_x0, stored_y0 = self.transform_coords(x0, y0)
+        stored_x1, stored_y1 = self.transform_coords(x1 - 1, y1 - 1)
+        self.pixel_area.fill_rect(min(stored_x0, stored_x1),
+                                  min(stored_y0, stored_y1),
+                                  abs(stored_x1 - stored_x0) + 1,
+                                  abs(stored_y1 - stored_y0) + 1, color)
+
+    def erase(self):
+        self.pixel_area.erase()
+
+    def get_bytes(self):
+        """
+        Returns the pixels of this tile, as they appear with its transforms, in
+        a bytearray of rows of RGBA values.
+        """
+        area = self.pixel_area
+        if not self.is_transformed():
+            return bytearray(area.get_rgba())
+        return bytearray(orient_pixels(area.get_rgba(),
+                                       self.get_orientation_maps()[0]))
+
+    def set_bytes(self, data):
+        """
+        Set every pixel of this tile at once from rows of RGBA values, as they
+        are to appear with its transforms, like the ones get_bytes returns.
+        """
+        if self.is_transformed():
+            data = orient_pixels(str(data), self.get_orientation_maps()[1])
+        self.pixel_area.set_rgba(data)
+
+    def restore(self, other):
+        """
+        Make this tile look like another tile, in place.
+        """
+        self.flip_x, self.flip_y = other.flip_x, other.flip_y
+        self.rotation = other.rotation
+        self.pixel_area.restore(other.pixel_area)
+
+    def get_tex_coords(self, region):
+        """
+        Returns the texture coordinates that show this tile, with its
+        transforms, from a texture region holding its pixels. They are in the
+        order of a quad's corners: bottom left, bottom right, top right, top
+        left.
+        """
+        corners = orient_corners(self.rotation, self.flip_x, self.flip_y)
+        tex_coords = region.tex_coords
+        return sum((tex_coords[corner*3:corner*3+3] for corner in corners), ())
+
+    def get_look(self):
+        """
+        Returns a value that changes whenever the way this tile looks changes.
+        """
+        return (self.pixel_area, self.pixel_area.version, self.rotation,
+                self.flip_x, self.flip_y)
 
     def copy(self, shallow=False):
-        copy = Tile(self.pixel_area.width, self.pixel_area.height)
-        copy.flip_x, copy.flip_y = self.flip_x, self.flip_y
-        copy.rotation = self.rotation
+        """
+        Returns a copy of this tile. A shallow copy uses the same pixel area;
+        otherwise the copy's pixel area shares this one's pixels until one of
+        them is written to.
+        """
         if shallow:
-            copy.pixel_area = self.pixel_area
+            pixel_area = self.pixel_area
         else:
-            copy.pixel_area = self.pixel_area.copy()
+            pixel_area = self.pixel_area.copy()
+        copy = Tile(pixel_area.width, pixel_area.height, pixel_area=pixel_area)
+        copy.tile_id = self.tile_id
+        copy.flip_x, copy.flip_y = self.flip_x, self.flip_y
+        copy.rotation = self.rotation
+        return copy
+
+class TileLibrary(object):
+    """
+    The shared set of tiles that the cells of a canvas show.
+
+    Each cell refers to a library tile by its id, with a rotation and flips of
+    its own. Drawing on a cell draws on the library tile, so every cell
+    showing that tile changes with it, and all of them are drawn from the
+    tile's one region of the canvas's texture atlas.
+    """
+
+    def __init__(self, tile_size, palette=None):
+        self.tile_size = tile_size
+        self.palette = palette
+        self.areas = OrderedDict()
+        #removed tiles are kept, since undoing can bring them back
+        self.removed = {}
+        self.next_id = 0
+
+    def __iter__(self):
+        return iter(self.areas)
+
+    def __len__(self):
+        return len(self.areas)
+
+    def __contains__(self, tile_id):
+        return tile_id in self.areas
+
+    def __getitem__(self, tile_id):
+        """
+        Returns the pixel area of a library tile. A removed tile is put back
+        into the library when it is asked for.
+        """
+        if tile_id in self.removed:
+            self.areas[tile_id] = self.removed.pop(tile_id)
+        return self.areas[tile_id]
+
+    def add(self, pixel_area=None):
+        """
+        Add a tile to the library, blank unless its pixel area is given.
+        Returns the new tile's id.
+        """
+        if pixel_area is None:
+            tile_w, tile_h = self.tile_size
+            if self.palette is not None:
+                pixel_area = IndexedPixelArea(tile_w, tile_h, self.palette)
+            else:
+                pixel_area = PixelArea(tile_w, tile_h)
+        tile_id = self.next_id
+        self.next_id += 1
+        self.areas[tile_id] = pixel_area
+        return tile_id
+
+    def remove(self, tile_id):
+        self.removed[tile_id] = self.areas.pop(tile_id)
+
+    def copy(self):
+        copy = TileLibrary(self.tile_size, self.palette)
+        copy.areas = OrderedDict((tile_id, area.copy())
+                                 for tile_id, area in self.areas.iteritems())
+        copy.removed = dict((tile_id, area.copy())
+                            for tile_id, area in self.removed.iteritems())
+        copy.next_id = self.next_id
         return copy
 
 class Canvas(object):
 
-    def __init__(self, tile_size, canvas_size, copy_from=None):
+    atlas_size = 2048, 2048
+
+    def __init__(self, tile_size, canvas_size, copy_from=None, tiles=None,
+                 palette=None, library=None):
+        """
+        Create a canvas of canvas_size tiles, each tile_size pixels. Given a
+        palette, the canvas is indexed: its pixels are stored as indices into
+        that palette.
+
+        Every cell of the canvas shows a tile from the canvas's tile library. A
+        new canvas gets a blank library tile for each cell. Tiles passed in
+        show tiles of the library passed with them, or if there is none, each
+        is added to a new library.
+        """
         self.tile_size = tile_size
         self.canvas_size = canvas_size
+        self.palette = palette
         width, height = (tile_size[0]*canvas_size[0],
                          tile_size[1]*canvas_size[1])
         self.width, self.height = width, height
 
-        self.tiles = []
-        for y in xrange(canvas_size[1]):
-            self.tiles.append([])
-            for x in xrange(canvas_size[0]):
-                if copy_from:
-                    tile = copy_from.tiles[y][x].copy()
-                else:
-                    tile = Tile(tile_size[0], tile_size[1])
-                self.tiles[y].append(tile)
+        if copy_from:
+            self.library = copy_from.library.copy()
+        else:
+            self.library = library
+            if library is None:
+                self.library = TileLibrary(tile_size, palette)
+
+        if tiles:
+            self.tiles = tiles
+            if library is None:
+                for row in tiles:
+                    for tile in row:
+                        tile.tile_id = self.library.add(tile.pixel_area)
+        else:
+            self.tiles = []
+            for y in xrange(canvas_size[1]):
+                self.tiles.append([])
+                for x in xrange(canvas_size[0]):
+                    if copy_from:
+                        tile = copy_from.tiles[y][x].copy(shallow=True)
+                    else:
+                        tile = Tile(tile_size[0], tile_size[1])
+                        tile.tile_id = self.library.add()
+                    tile.pixel_area = self.library[tile.tile_id]
+                    self.tiles[y].append(tile)
+
+        self.journal = None
+
+        #the cells showing each library tile
+        self.cells_by_id = {}
+        for tile_y, row in enumerate(self.tiles):
+            for tile_x, tile in enumerate(row):
+                self.cells_by_id.setdefault(tile.tile_id, set()).add(
+                    (tile_x, tile_y))
+        #what has changed since each consumer of changes last took them
+        self.changed_cells = {}
+        self.changed_ids = {}
+
+        self.batch = None
+        self.atlas = None
+        self.groups = {}
+        self.quads = {}
+        self.quad_scale = None
+        self.quad_cells = None
+
+    def start_journal(self):
+        """
+        Start remembering the state of every tile before it is first changed.
+        """
+        self.journal = OrderedDict()
+
+    def stop_journal(self):
+        """
+        Stop remembering tile states. Returns an ordered mapping from the
+        (tile_x, tile_y) coordinates of each changed tile to a copy of that tile
+        as it was before the first change.
+        """
+        journal, self.journal = self.journal, None
+        return journal
+
+    def touch_tile(self, tile_x, tile_y):
+        """
+        Must be called before a tile is changed, so the journal and the
+        consumers of changes can keep track.
+        """
+        if self.journal is not None and (tile_x, tile_y) not in self.journal:
+            self.journal[tile_x, tile_y] = self.tiles[tile_y][tile_x].copy()
+        #every cell showing the same library tile changes along with this one
+        tile_id = self.tiles[tile_y][tile_x].tile_id
+        for tile_ids in self.changed_ids.itervalues():
+            tile_ids.add(tile_id)
+
+    def mark_cell_changed(self, tile_x, tile_y):
+        """
+        Note that a cell has changed which library tile it shows, or how.
+        """
+        for cells in self.changed_cells.itervalues():
+            cells.add((tile_x, tile_y))
+
+    def show_tile(self, tile_x, tile_y, tile_id):
+        tile = self.tiles[tile_y][tile_x]
+        self.cells_by_id[tile.tile_id].discard((tile_x, tile_y))
+        self.cells_by_id.setdefault(tile_id, set()).add((tile_x, tile_y))
+        tile.tile_id = tile_id
+        tile.pixel_area = self.library[tile_id]
+        self.mark_cell_changed(tile_x, tile_y)
+
+    def take_changes(self, consumer):
+        """
+        Returns the set of (tile_x, tile_y) cells that have changed since a
+        consumer last took its changes, and starts over for that consumer.
+        Consumers are told apart by name, and each keeps its own changes, so
+        the renderer, an exporter and so on don't get in each other's way. The
+        first time a consumer asks, every cell counts as changed.
+        """
+        if consumer not in self.changed_cells:
+            self.changed_cells[consumer] = set()
+            self.changed_ids[consumer] = set()
+            return set(product(xrange(self.canvas_size[0]),
+                               xrange(self.canvas_size[1])))
+
+        cells, self.changed_cells[consumer] = \
+            self.changed_cells[consumer], set()
+        for tile_id in self.changed_ids[consumer]:
+            cells.update(self.cells_by_id.get(tile_id, ()))
+        self.changed_ids[consumer] = set()
+        return cells
+
+    def drop_changes(self, consumer):
+        """
+        Stop keeping changes for a consumer that won't take them any more.
+        """
+        self.changed_cells.pop(consumer, None)
+        self.changed_ids.pop(consumer, None)
+
+    def restore_tile(self, tile_x, tile_y, saved):
+        """
+        Put a cell back the way a saved copy of its tile was: showing the same
+        library tile, with the same transforms, and with the library tile's
+        pixels restored in place.
+        """
+        self.show_tile(tile_x, tile_y, saved.tile_id)
+        self.touch_tile(tile_x, tile_y)
+        self.tiles[tile_y][tile_x].restore(saved)
+
+    def place_tile(self, tile_x, tile_y, tile_id, rotation=0, flip_x=False,
+                   flip_y=False):
+        """
+        Make a cell show a tile from the library, with the given transforms.
+        Only square tiles can be turned on their side, so a rotation of 90 or
+        270 degrees raises ValueError for any other tiles.
+        """
+        tile_w, tile_h = self.tile_size
+        if rotation % 180 and tile_w != tile_h:
+            raise ValueError("%dx%d tiles can't be rotated by %d degrees" %
+                             (tile_w, tile_h, rotation))
+        tile = self.tiles[tile_y][tile_x]
+        if (tile.tile_id, tile.rotation, tile.flip_x, tile.flip_y) == \
+                (tile_id, rotation, flip_x, flip_y):
+            return
+        self.touch_tile(tile_x, tile_y)
+        self.show_tile(tile_x, tile_y, tile_id)
+        tile.rotation, tile.flip_x, tile.flip_y = rotation, flip_x, flip_y
+
+    def get_tile_uses(self):
+        """
+        Returns a dict from the id of each library tile shown on the canvas to
+        the number of cells showing it.
+        """
+        return Counter(tile.tile_id for row in self.tiles for tile in row)
+
+    def remove_library_tile(self, tile_id):
+        """
+        Remove a tile from the library, if no cell shows it. Returns whether
+        it was removed.
+        """
+        if tile_id not in self.library or self.get_tile_uses()[tile_id]:
+            return False
+        self.library.remove(tile_id)
+        return True
+
+    def purge_library(self):
+        """
+        Remove every tile no cell shows from the library. Returns how many
+        were removed.
+        """
+        uses = self.get_tile_uses()
+        unused = [tile_id for tile_id in self.library if not uses[tile_id]]
+        for tile_id in unused:
+            self.library.remove(tile_id)
+        return len(unused)
 
     def set_pixel(self, x, y, color):
         tile_x, tile_y = x // self.tile_size[0], y // self.tile_size[1]
         pix_x, pix_y = x % self.tile_size[0], y % self.tile_size[1]
 
+        self.touch_tile(tile_x, tile_y)
         self.tiles[tile_y][tile_x].set_pixel(pix_x, pix_y, color)
 
+    def fill_rect(self, x, y, width, height, color):
+        """
+        Set every pixel in a rectangle to one color. The rectangle is clipped to
+        the canvas, and split up so each tile it covers is filled in one go.
+        """
+        x0, y0 = max(x, 0), max(y, 0)
+        x1, y1 = min(x + width, self.width), min(y + height, self.height)
+        if x0 >= x1 or y0 >= y1:
+            return
+
+        tile_w, tile_h = self.tile_size
+        for tile_y in xrange(y0 // tile_h, (y1 - 1) // tile_h + 1):
+            bottom = max(y0, tile_y * tile_h)
+            top = min(y1, (tile_y + 1) * tile_h)
+            for tile_x in xrange(x0 // tile_w, (x1 - 1) // tile_w + 1):
+                left = max(x0, tile_x * tile_w)
+                right = min(x1, (tile_x + 1) * tile_w)
+                self.touch_tile(tile_x, tile_y)
+                self.tiles[tile_y][tile_x].fill_rect(
+                    left - tile_x * tile_w, bottom - tile_y * tile_h,
+                    right - left, top - bottom, color)
+
+    def fill_spans(self, spans, color):
+        """
+        Fill horizontal spans of pixels with one color. Each span is a tuple of
+        (y, start_x, end_x), with both ends included.
+        """
+        for y, start_x, end_x in spans:
+            self.fill_rect(start_x, y, end_x - start_x + 1, 1, color)
+
+    def erase_tile(self, tile_x, tile_y):
+        self.touch_tile(tile_x, tile_y)
+        self.tiles[tile_y][tile_x].erase()
+
+    def set_tile_bytes(self, tile_x, tile_y, data):
+        """
+        Set every pixel of a cell at once from rows of RGBA values, as they
+        are to appear on the canvas.
+        """
+        self.touch_tile(tile_x, tile_y)
+        self.tiles[tile_y][tile_x].set_bytes(data)
+
     def get_pixel(self, x, y):
         tile_x, tile_y = x // self.tile_size[0], y // self.tile_size[1]
         pix_x, pix_y = x % self.tile_size[0], y % self.tile_size[1]
 
         return self.tiles[tile_y][tile_x].get_pixel(pix_x, pix_y)
 
+    def get_cells_bytes(self, left=0, bottom=0, columns=None, rows=None,
+                        pixels=None, pitch=None, start=0):
+        """
+        Returns the pixels of a rectangle of cells, with tile transforms
+        applied, as one bytearray of RGBA rows starting from the bottom. The
+        rectangle has cell (left, bottom) at its bottom left, and by default
+        goes to the canvas's top right.
+
+        Given a bytearray of pixels, the cells are copied into that instead,
+        with their bottom left pixel at byte start and their rows pitch bytes
+        apart, and it is returned.
+        """
+        if columns is None:
+            columns = self.canvas_size[0] - left
+        if rows is None:
+            rows = self.canvas_size[1] - bottom
+        tile_w, tile_h = self.tile_size
+        tile_pitch = tile_w * 4
+        if pixels is None:
+            pitch = columns * tile_pitch
+            pixels = bytearray(pitch * rows * tile_h)
+        for row in xrange(rows):
+            for column in xrange(columns):
+                tile_bytes = self.tiles[bottom + row][left + column].get_bytes()
+                tile_start = start + row * tile_h * pitch + column * tile_pitch
+                for y in xrange(tile_h):
+                    dest = tile_start + y * pitch
+                    source = y * tile_pitch
+                    pixels[dest:dest+tile_pitch] = \
+                        tile_bytes[source:source+tile_pitch]
+        return pixels
+
+    def get_composite(self):
+        """
+        Returns all of the canvas's pixels, with tile transforms applied, as
+        one bytearray of RGBA rows that are each width pixels long.
+        """
+        return self.get_cells_bytes()
+
+    def get_color_index(self):
+        """
+        Returns a dict from each color used on the canvas to another dict, from
+        the (tile_x, tile_y) coordinates of each tile the color is used in to
+        the number of pixels of that color in the tile.
+
+        This is put together from counts that each tile's pixels keep up to
+        date, so once they have been made, no pixels are looked at.
+        """
+        index = {}
+        for tile_y, row in enumerate(self.tiles):
+            for tile_x, tile in enumerate(row):
+                counts = tile.pixel_area.get_color_counts()
+                for color, count in counts.iteritems():
+                    index.setdefault(color, {})[tile_x, tile_y] = count
+        return index
+
+    def get_color_counts(self):
+        """
+        Returns a dict from each color used on the canvas to the number of
+        pixels in that color.
+        """
+        totals = Counter()
+        for row in self.tiles:
+            for tile in row:
+                totals.update(tile.pixel_area.get_color_counts())
+        return totals
+
+    def replace_color(self, old_color, new_color):
+        """
+        Change every pixel of one color on the canvas to another color. Only the
+        tiles that have the old color in them are touched. Returns how many
+        pixels were changed.
+        """
+        old_color, new_color = tuple(old_color), tuple(new_color)
+        if old_color == new_color:
+            return 0
+
+        replaced = 0
+        for tile_y, row in enumerate(self.tiles):
+            for tile_x, tile in enumerate(row):
+                if old_color in tile.pixel_area.get_color_counts():
+                    self.touch_tile(tile_x, tile_y)
+                    replaced += tile.pixel_area.replace_color(old_color,
+                                                              new_color)
+        return replaced
+
+    def remap_tile_colors(self, tile_x, tile_y, table):
+        """
+        Change the colors of one tile's pixels through a dict from old colors to
+        new ones, as PixelArea.remap_colors does. Returns how many pixels were
+        changed.
+        """
+        pixel_area = self.tiles[tile_y][tile_x].pixel_area
+        counts = pixel_area.get_color_counts()
+        if not any(tuple(old) in counts and tuple(old) != tuple(new)
+                   for old, new in table.iteritems()):
+            return 0
+        self.touch_tile(tile_x, tile_y)
+        return pixel_area.remap_colors(table)
+
+    def palette_changed(self, entry):
+        """
+        Must be called after an entry of an indexed canvas's palette is
+        changed. The tiles using it are recolored the next time they are drawn;
+        none of their pixels are touched.
+        """
+        if self.palette is None:
+            return
+        for tile_id in self.library:
+            if self.library[tile_id].palette_changed(entry):
+                for tile_ids in self.changed_ids.itervalues():
+                    tile_ids.add(tile_id)
+
+    def match_tiles(self):
+        """
+        Find the tiles that look the same as an earlier tile, when that tile's
+        pixels are rotated or flipped any of the 8 ways they can be. Tiles are
+        compared by hashes of their stored pixels.
+
+        Returns the number of unique tiles, and a dict from the (tile_x,
+        tile_y) of each other tile to the (tile_x, tile_y) of the earlier tile
+        and the (rotation, flip_x, flip_y) that make it look the same.
+        """
+        tile_w, tile_h = self.tile_size
+        #rotating a square by 180 and flipping it one way is the same as
+        #flipping it the other way, so this covers every distinct orientation
+        rotations = (0, 90, 180, 270) if tile_w == tile_h else (0, 180)
+        #the untransformed orientation comes first, so that a tile that looks
+        #the same as an earlier one as it is gets matched without transforms
+        orientations = [((rotation, flip_x, False),
+                         get_orientation_maps(tile_w, tile_h, rotation,
+                                              flip_x)[0])
+                        for rotation in rotations for flip_x in (False, True)]
+
+        seen = {}
+        matches = {}
+        unique = 0
+        for tile_y, row in enumerate(self.tiles):
+            for tile_x, tile in enumerate(row):
+                area = tile.pixel_area
+                pixel_size = len(area.ctypes_data) // (tile_w * tile_h)
+                stored = ctypes.string_at(area.ctypes_data,
+                                          len(area.ctypes_data))
+                look = hashlib.sha1(orient_pixels(
+                    stored, tile.get_orientation_maps()[0],
+                    pixel_size)).digest()
+                if look in seen:
+                    matches[tile_x, tile_y] = seen[look]
+                    continue
+
+                unique += 1
+                for orientation, mapping in orientations:
+                    oriented = hashlib.sha1(
+                        orient_pixels(stored, mapping, pixel_size)).digest()
+                    seen.setdefault(oriented, ((tile_x, tile_y), orientation))
+        return unique, matches
+
+    def count_unique_tiles(self):
+        return self.match_tiles()[0]
+
+    def deduplicate(self):
+        """
+        Make every cell that looks the same as an earlier cell show that
+        cell's library tile instead, with whatever transforms make it look the
+        same. The library tiles this leaves unused are removed from the
+        library. Returns the number of unique tiles.
+        """
+        unique, matches = self.match_tiles()
+        replaced = set()
+        for (tile_x, tile_y), ((match_x, match_y), orientation) in \
+                matches.iteritems():
+            tile_id = self.tiles[tile_y][tile_x].tile_id
+            match_id = self.tiles[match_y][match_x].tile_id
+            if tile_id != match_id:
+                replaced.add(tile_id)
+            self.place_tile(tile_x, tile_y, match_id, *orientation)
+
+        uses = self.get_tile_uses()
+        for tile_id in replaced:
+            if not uses[tile_id]:
+                self.library.remove(tile_id)
+        return unique
+
     def copy(self):
-        return Canvas(self.tile_size, self.canvas_size, copy_from=self)
-
-    def get_sprites(self, scale):
-        sprites = []
-        batch = pyglet.graphics.Batch()
-        for y, row in enumerate(self.tiles):
-            for x, tile in enumerate(row):
-                if tile:
-                    s_x = self.tile_size[0] * scale * x
-                    s_y = self.tile_size[1] * scale * y
-                    with_transforms = tile.get_transformed()
-                    sprite = pyglet.sprite.Sprite(with_transforms, x=s_x, y=s_y, batch=batch)
-                    sprite.scale = scale
-                    gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MAG_FILTER,
-                                       gl.GL_NEAREST)
-                    sprites.append(sprite)
-        return sprites, batch
+        return Canvas(self.tile_size, self.canvas_size, copy_from=self,
+                      palette=self.palette)
+
+    def get_atlas_region(self, pixel_area):
+        """
+        Returns the region of the canvas's texture atlas that holds the pixels
+        of a library tile, with any changes to them uploaded. A tile is only
+        added to the atlas the first time it is drawn.
+        """
+        if self.atlas is None:
+            self.atlas = pyglet.image.atlas.TextureBin(*self.atlas_size,
+                                                       border=True)
+        if pixel_area.atlas_region is None:
+            region = self.atlas.add(pixel_area)
+            uploads.count(pixel_area.width * pixel_area.height * 4)
+            if region.id not in self.groups:
+                #a new atlas texture
+                gl.glBindTexture(region.target, region.id)
+                gl.glTexParameteri(region.target, gl.GL_TEXTURE_MAG_FILTER,
+                                   gl.GL_NEAREST)
+                gl.glTexParameteri(region.target, gl.GL_TEXTURE_MIN_FILTER,
+                                   gl.GL_NEAREST)
+                self.groups[region.id] = pyglet.graphics.TextureGroup(
+                    region.owner)
+            pixel_area.atlas_region = region
+        elif pixel_area.dirty:
+            pixel_area.flush_changes()
+        return pixel_area.atlas_region
+
+    @stats.timed("get_batch")
+    def get_batch(self, scale, cells=None):
+        """
+        Returns the batch that draws the canvas at the given scale. Given a
+        rectangle of cells, as (left, bottom, right, top) with right and top
+        just past the last column and row, only those cells are drawn; by
+        default, all of them are.
+
+        The pixels of the library tiles are packed into one texture atlas (or a
+        few, if they don't fit), and each cell is a quad showing its tile's
+        region of the atlas, so the canvas is drawn in one call. A cell's
+        transforms are applied through the order of its texture coordinates.
+
+        The quads are kept from one call to the next. Only the cells that have
+        changed since the last call get new texture coordinates, and unless
+        the scale or the cells drawn change, no others are looked at. Cells
+        that are no longer drawn have their quads thrown away.
+        """
+        if self.batch is None:
+            self.batch = pyglet.graphics.Batch()
+        changed = self.take_changes("batch")
+
+        columns, rows = self.canvas_size
+        left, bottom, right, top = cells or (0, 0, columns, rows)
+        cells = (max(left, 0), max(bottom, 0),
+                 min(right, columns), min(top, rows))
+        left, bottom, right, top = cells
+        if cells != self.quad_cells:
+            for x, y in self.quads.keys():
+                if not (left <= x < right and bottom <= y < top):
+                    self.quads.pop((x, y))[0].delete()
+        if cells != self.quad_cells or scale != self.quad_scale:
+            to_update = product(xrange(left, right), xrange(bottom, top))
+        else:
+            to_update = [(x, y) for x, y in changed
+                         if left <= x < right and bottom <= y < top]
+
+        tile_w, tile_h = self.tile_size
+        for x, y in to_update:
+            quad, group = self.quads.get((x, y), (None, None))
+            if quad is None or (x, y) in changed:
+                tile = self.tiles[y][x]
+                region = self.get_atlas_region(tile.pixel_area)
+                new_group = self.groups[region.id]
+                tex_coords = tile.get_tex_coords(region)
+                if quad is None:
+                    new_quad = self.batch.add(4, gl.GL_QUADS, new_group, "v2f",
+                                              ("t3f", tex_coords))
+                else:
+                    new_quad = quad
+                    if new_group is not group:
+                        self.batch.migrate(quad, gl.GL_QUADS, new_group,
+                                           self.batch)
+                    quad.tex_coords = tex_coords
+                self.quads[x, y] = new_quad, new_group
+            else:
+                new_quad = quad
+            if quad is None or scale != self.quad_scale:
+                x0, y0 = tile_w * scale * x, tile_h * scale * y
+                x1, y1 = x0 + tile_w * scale, y0 + tile_h * scale
+                new_quad.vertices = (x0, y0, x1, y0, x1, y1, x0, y1)
+        self.quad_cells = cells
+        self.quad_scale = scale
+        return self.batch
 
     def get_tile(self, x, y):
         return x // self.tile_size[0], y // self.tile_size[1]
 
+class Overlay(object):
+    """
+    A sparse layer of pixels that sits on top of a canvas without changing it.
+
+    Tools can be run on an overlay just as they are on a canvas, which makes it
+    cheap to preview an action that is still in progress. The rectangles and
+    spans a tool fills are stored as they are, as (x, y, width, height, color)
+    rects in the order they were filled, so a big shape costs no more to keep
+    or to draw than the number of rects it is made of.
+    """
+
+    def __init__(self, canvas):
+        self.canvas = canvas
+        self.tile_size = canvas.tile_size
+        self.canvas_size = canvas.canvas_size
+        self.width, self.height = canvas.width, canvas.height
+        self.rects = []
+
+    def set_pixel(self, x, y, color):
+        self.fill_rect(x, y, 1, 1, color)
+
+    def get_pixel(self, x, y):
+        #the last rect filled over a pixel is the one that shows
+        for left, bottom, width, height, color in reversed(self.rects):
+            if left <= x < left + width and bottom <= y < bottom + height:
+                return list(color)
+        return self.canvas.get_pixel(x, y)
+
+    def fill_rect(self, x, y, width, height, color):
+        x0, y0 = max(x, 0), max(y, 0)
+        x1, y1 = min(x + width, self.width), min(y + height, self.height)
+        if x1 > x0 and y1 > y0:
+            self.rects.append((x0, y0, x1 - x0, y1 - y0, tuple(color)))
+
+    def fill_spans(self, spans, color):
+        for y, start_x, end_x in spans:
+            self.fill_rect(start_x, y, end_x - start_x + 1, 1, color)
+
+    def get_tile(self, x, y):
+        return self.canvas.get_tile(x, y)
+
+def default_palette():
+    return list(product((0, 127, 255), repeat=3)) + [(0,0,0)]*13
+
 class SlammerModel(object):
     """
     Contains the data for the Pixel Slammer application.
     """
 
-    def __init__(self, tile_size=(16,16), canvas_size=(4,4), canvas=None):
-        self.canvas = canvas or Canvas(tile_size, canvas_size)
+    def __init__(self, tile_size=(16,16), canvas_size=(4,4), canvas=None,
+                 palette=None, indexed=False):
+        """
+        Create a model, with a new canvas unless one is given. With indexed
+        set, the new canvas stores its pixels as indices into the palette.
+        """
+        if canvas is not None and canvas.palette is not None:
+            palette = canvas.palette
+        elif not isinstance(palette, Palette):
+            palette = Palette(palette or default_palette())
+        self.palette = palette
+        self.canvas = canvas or Canvas(tile_size, canvas_size,
+                                       palette=palette if indexed else None)
 
     def copy(self):
-        return SlammerModel(None, None, canvas=self.canvas.copy())
+        return SlammerModel(None, None, canvas=self.canvas.copy(),
+                            palette=list(self.palette))
@@ -0,0 +1,168 @@
+"""
+Reading and writing Pixel Slammer project files.
+
+A project file is laid out as:
+
+    header          magic, format version, flags, tile size, canvas size and
+                    the number of palette entries
+    library size    the number of tiles in the tile library, as 4 bytes
+    palette         3 bytes (RGB) per entry
+    tile records    8 bytes per cell, in rows from the bottom: the place in the
+                    library of the tile the cell shows as 4 bytes, rotation in
+                    degrees as a short, then a byte of flip flags and a pad byte
+    pixels          the RGBA bytes of every library tile, one tile after
+                    another, starting on a 16 byte boundary. In an indexed
+                    project, each pixel is instead one byte, an index into the
+                    palette
+
+In a compressed project, the pixel section is one zlib stream instead. The
+pixels of an uncompressed project are memory mapped when it is loaded, so
+opening one costs about the same whatever its size, and each tile's pixels are
+only read from disk once something looks at them.
+"""
+
+__author__ = 'cseebach'
+
+import ctypes
+import mmap
+import os
+import struct
+import zlib
+
+from model import (Canvas, IndexedPixelArea, Palette, PixelArea,
+                   SlammerModel, Tile, TileLibrary)
+
+MAGIC = "PSLM"
+VERSION = 1
+
+COMPRESSED = 1
+INDEXED = 2
+
+FLIP_X = 1
+FLIP_Y = 2
+
+header_format = struct.Struct("<4sHHIIIII")
+library_format = struct.Struct("<I")
+palette_format = struct.Struct("<BBB")
+record_format = struct.Struct("<IHBx")
+
+PIXELS_ALIGNMENT = 16
+
+def pixels_offset(end):
+    """
+    Returns where the pixel section starts, when what comes before it ends at
+    the given offset.
+    """
+    return -(-end // PIXELS_ALIGNMENT) * PIXELS_ALIGNMENT
+
+def save_project(model, path, compress=False):
+    """
+    Write a model out to a project file.
+
+    The project is written to a temporary file that then replaces the old one,
+    since the pixels of a loaded project may still be mapped from that file.
+    """
+    canvas = model.canvas
+    tiles = [tile for row in canvas.tiles for tile in row]
+    places = dict((tile_id, place)
+                  for place, tile_id in enumerate(canvas.library))
+    flags = ((COMPRESSED if compress else 0) |
+             (INDEXED if canvas.palette is not None else 0))
+
+    temp_path = path + ".tmp"
+    with open(temp_path, "wb") as project_file:
+        project_file.write(header_format.pack(
+            MAGIC, VERSION, flags,
+            canvas.tile_size[0], canvas.tile_size[1],
+            canvas.canvas_size[0], canvas.canvas_size[1], len(model.palette)))
+        project_file.write(library_format.pack(len(canvas.library)))
+        for color in model.palette:
+            project_file.write(palette_format.pack(*color[:3]))
+        for tile in tiles:
+            flags = (FLIP_X if tile.flip_x else 0) | (FLIP_Y if tile.flip_y else 0)
+            project_file.write(record_format.pack(places[tile.tile_id],
+                                                  tile.rotation % 360, flags))
+
+        offset = pixels_offset(project_file.tell())
+        project_file.write("\0" * (offset - project_file.tell()))
+
+        compressor = zlib.compressobj() if compress else None
+        for tile_id in canvas.library:
+            pixels = buffer(canvas.library[tile_id].ctypes_data)
+            if compressor:
+                project_file.write(compressor.compress(pixels))
+            else:
+                project_file.write(pixels)
+        if compressor:
+            project_file.write(compressor.flush())
+
+    if os.name == "nt" and os.path.exists(path):
+        os.remove(path)
+    os.rename(temp_path, path)
+
+def load_project(path):
+    """
+    Read a model from a project file.
+    """
+    with open(path, "rb") as project_file:
+        header = project_file.read(header_format.size)
+        if len(header) < header_format.size:
+            raise ValueError("%s is not a Pixel Slammer project" % path)
+        (magic, version, flags, tile_w, tile_h, columns, rows,
+         num_colors) = header_format.unpack(header)
+        if magic != MAGIC:
+            raise ValueError("%s is not a Pixel Slammer project" % path)
+        if version > VERSION:
+            raise ValueError("%s was saved by a newer Pixel Slammer" % path)
+
+        num_library, = library_format.unpack(
+            project_file.read(library_format.size))
+        palette = Palette(
+            palette_format.unpack(project_file.read(palette_format.size))
+            for i in xrange(num_colors))
+        records = [record_format.unpack(project_file.read(record_format.size))
+                   for i in xrange(columns * rows)]
+
+        offset = pixels_offset(project_file.tell())
+        if flags & COMPRESSED:
+            project_file.seek(offset)
+            pixels = bytearray(zlib.decompress(project_file.read()))
+            offset = 0
+        else:
+            #a private mapping is writable without changing the file, and
+            #reads the file in lazily, a page at a time
+            pixels = mmap.mmap(project_file.fileno(), 0,
+                               access=mmap.ACCESS_COPY)
+
+    indexed = bool(flags & INDEXED)
+    tile_bytes = tile_w * tile_h * (1 if indexed else 4)
+    if len(pixels) < offset + tile_bytes * num_library:
+        raise ValueError("%s is cut short" % path)
+    buffer_type = ctypes.c_ubyte * tile_bytes
+
+    library = TileLibrary((tile_w, tile_h), palette if indexed else None)
+    for place in xrange(num_library):
+        tile_data = buffer_type.from_buffer(pixels, offset + place * tile_bytes)
+        if indexed:
+            library.add(IndexedPixelArea(tile_w, tile_h, palette,
+                                         ctypes_data=tile_data))
+        else:
+            library.add(PixelArea(tile_w, tile_h, ctypes_data=tile_data))
+
+    tiles = []
+    for y in xrange(rows):
+        tiles.append([])
+        for x in xrange(columns):
+            place, rotation, tile_flags = records[y * columns + x]
+            if place >= num_library:
+                raise ValueError("%s refers to a missing tile" % path)
+            tile = Tile(tile_w, tile_h, pixel_area=library[place])
+            tile.tile_id = place
+            tile.rotation = rotation
+            tile.flip_x = bool(tile_flags & FLIP_X)
+            tile.flip_y = bool(tile_flags & FLIP_Y)
+            tiles[y].append(tile)
+
+    canvas = Canvas((tile_w, tile_h), (columns, rows), tiles=tiles,
+                    palette=palette if indexed else None, library=library)
+    return SlammerModel(canvas=canvas, palette=palette)
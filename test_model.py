@@ -0,0 +1,192 @@
+"""
+Tests for the model, without a display:
+
+    python -m unittest test_model
+"""
+
+__author__ = 'cseebach'
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import pyglet
+pyglet.options["shadow_window"] = False
+
+from history import History
+from model import Canvas, Overlay, PixelArea, SlammerModel, Tile
+from project import load_project, save_project
+
+class DeduplicateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def repeated_canvas(self):
+        """
+        An 8x8 canvas with the same tile drawn in every cell.
+        """
+        canvas = Canvas((4, 4), (8, 8))
+        for tile_x in xrange(8):
+            for tile_y in xrange(8):
+                canvas.set_pixel(tile_x * 4 + 1, tile_y * 4 + 2,
+                                 (255, 0, 0, 255))
+        return canvas
+
+    def save(self, canvas, name):
+        path = os.path.join(self.temp_dir, name)
+        save_project(SlammerModel(canvas=canvas), path)
+        return path
+
+    def test_shrinks_library_and_project(self):
+        canvas = self.repeated_canvas()
+        before = os.path.getsize(self.save(canvas, "before.pslm"))
+        composite = canvas.get_composite()
+
+        self.assertEqual(canvas.deduplicate(), 1)
+        self.assertEqual(len(canvas.library), 1)
+        self.assertEqual(canvas.get_composite(), composite)
+        path = self.save(canvas, "after.pslm")
+        self.assertLess(os.path.getsize(path), before)
+        self.assertEqual(len(load_project(path).canvas.library), 1)
+
+    def test_edits_reach_every_cell(self):
+        canvas = self.repeated_canvas()
+        canvas.deduplicate()
+        canvas.set_pixel(0, 0, (0, 255, 0, 255))
+        self.assertEqual(list(canvas.get_pixel(28, 28)), [0, 255, 0, 255])
+
+    def test_keeps_unused_library_tiles(self):
+        canvas = self.repeated_canvas()
+        kept = canvas.library.add()
+        canvas.deduplicate()
+        self.assertIn(kept, canvas.library)
+
+class TransformedTileTest(unittest.TestCase):
+
+    color = (255, 0, 0, 255)
+
+    def rotated_tile(self):
+        tile = Tile(4, 4)
+        tile.rotate(90)
+        return tile
+
+    def filled(self, tile):
+        return [(x, y) for x in xrange(4) for y in xrange(4)
+                if tuple(tile.get_pixel(x, y)) == self.color]
+
+    def test_fill_rect_clips_near_edges(self):
+        tile = self.rotated_tile()
+        tile.fill_rect(-1, 0, 2, 1, self.color)
+        self.assertEqual(self.filled(tile), [(0, 0)])
+
+    def test_fill_rect_clips_far_edges(self):
+        tile = self.rotated_tile()
+        tile.fill_rect(3, 2, 4, 4, self.color)
+        self.assertEqual(self.filled(tile), [(3, 2), (3, 3)])
+
+    def test_fill_rect_off_tile(self):
+        tile = self.rotated_tile()
+        tile.fill_rect(4, 0, 2, 2, self.color)
+        tile.fill_rect(-3, -3, 2, 2, self.color)
+        self.assertEqual(self.filled(tile), [])
+
+    def test_transform_coords_rejects_points_off_tile(self):
+        tile = self.rotated_tile()
+        for x, y in ((-1, 0), (0, -1), (4, 0), (0, 4)):
+            self.assertRaises(IndexError, tile.transform_coords, x, y)
+
+class OverlayTest(unittest.TestCase):
+
+    red, green = (255, 0, 0, 255), (0, 255, 0, 255)
+
+    def test_keeps_rects_as_filled(self):
+        overlay = Overlay(Canvas((16, 16), (32, 32)))
+        overlay.fill_rect(0, 0, 512, 512, self.red)
+        overlay.fill_spans([(y, 10, 20) for y in xrange(100)], self.green)
+        self.assertEqual(len(overlay.rects), 101)
+
+    def test_last_rect_shows(self):
+        canvas = Canvas((4, 4), (2, 2))
+        overlay = Overlay(canvas)
+        overlay.fill_rect(0, 0, 4, 4, self.red)
+        overlay.set_pixel(1, 1, self.green)
+        self.assertEqual(overlay.get_pixel(1, 1), list(self.green))
+        self.assertEqual(overlay.get_pixel(2, 2), list(self.red))
+        self.assertEqual(list(overlay.get_pixel(5, 5)),
+                         list(canvas.get_pixel(5, 5)))
+
+    def test_clips_to_canvas(self):
+        overlay = Overlay(Canvas((4, 4), (2, 2)))
+        overlay.fill_rect(-2, 6, 4, 4, self.red)
+        overlay.fill_rect(8, 0, 1, 1, self.red)
+        self.assertEqual(overlay.rects, [(0, 6, 2, 2, self.red)])
+
+class PlaceTileTest(unittest.TestCase):
+
+    def test_rotates_square_tiles(self):
+        canvas = Canvas((4, 4), (2, 2))
+        canvas.place_tile(1, 0, canvas.tiles[0][0].tile_id, 90)
+        self.assertEqual(canvas.tiles[0][1].rotation, 90)
+
+    def test_rejects_sideways_non_square_tiles(self):
+        canvas = Canvas((4, 2), (2, 2))
+        tile_id = canvas.tiles[0][0].tile_id
+        for rotation in (90, 270):
+            self.assertRaises(ValueError, canvas.place_tile, 1, 0, tile_id,
+                              rotation)
+        canvas.place_tile(1, 0, tile_id, 180)
+        canvas.set_pixel(4, 0, (255, 0, 0, 255))
+        self.assertEqual(len(canvas.tiles[0][1].get_bytes()), 4 * 2 * 4)
+
+class FillCanvas(object):
+
+    def __init__(self, color):
+        self.color = color
+
+    def do(self, canvas):
+        canvas.fill_rect(0, 0, canvas.width, canvas.height, self.color)
+
+class SharedPixelsTest(unittest.TestCase):
+
+    red = (255, 0, 0, 255)
+
+    def test_copies_pixels_while_shared(self):
+        area = PixelArea(4, 4)
+        copy = area.copy()
+        area.set_pixel(0, 0, self.red)
+        self.assertIsNot(area.ctypes_data, copy.ctypes_data)
+        self.assertEqual(list(copy.get_pixel(0, 0)), [0, 0, 0, 0])
+
+    def test_no_copy_once_sharers_are_gone(self):
+        area = PixelArea(4, 4)
+        pixels = area.ctypes_data
+        area.copy()
+        area.set_pixel(0, 0, self.red)
+        self.assertIs(area.ctypes_data, pixels)
+
+    def test_no_copy_after_dropping_canvas_copy(self):
+        canvas = Canvas((4, 4), (2, 2))
+        area = canvas.tiles[0][0].pixel_area
+        pixels = area.ctypes_data
+        canvas.copy()
+        canvas.set_pixel(0, 0, self.red)
+        self.assertIs(area.ctypes_data, pixels)
+
+    def test_no_copy_after_undo_and_redo(self):
+        canvas = Canvas((4, 4), (2, 2))
+        history = History()
+        history.do(FillCanvas(self.red), canvas)
+        history.undo(canvas)
+        history.redo(canvas)
+        area = canvas.tiles[0][0].pixel_area
+        pixels = area.ctypes_data
+        canvas.set_pixel(0, 0, (0, 255, 0, 255))
+        self.assertIs(area.ctypes_data, pixels)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,598 @@
+from array import array
+
+import pyglet
+
+__author__ = 'cseebach'
+
+class Tool(object):
+    """
+    A base class for each kind of tool available in Pixel Slammer.
+
+    The Tool workflow:
+        Create the tool you want to use.
+
+        Send it input until the input accepting methods return an object that
+        evaluates to False. Alternatively, check is_ready to determine when
+        enough input has been sent.
+
+        Call the do() method of the created tool. This can be done multiple
+        times if you like. (Handy for undo/redo functionality)
+    """
+
+    #whether to show what the tool would do while it is still accepting input
+    previews = True
+
+    def __init__(self, color, ctrl):
+        """Create a new Tool, and give it the color it should apply."""
+        self.color = color
+        self._is_ready = False
+        self.ctrl = ctrl
+
+    def accept_press(self, x, y):
+        """
+        Send a mouse press to this tool. Returns the result of is_ready after this
+        call is executed.
+        """
+        self._accept_press(x, y)
+        return self.is_ready()
+
+    def _accept_press(self, x, y):
+        """
+        Where the actual work of accepting the press information is done.
+        """
+
+    def accept_drag(self, start_x, start_y, end_x, end_y):
+        """
+        Send a mouse drag to this tool. Returns the result of is_ready after this
+        call is executed.
+        """
+        self._accept_drag(start_x, start_y, end_x, end_y)
+        return self.is_ready()
+
+    def _accept_drag(self, start_x, start_y, end_x, end_y):
+        """
+        Where the actual work of accepting drag information is done.
+        """
+
+    def accept_path(self, points):
+        """
+        Send a mouse drag through several points at once, as a list of (x, y)
+        points starting where the last input left off. Returns the result of
+        is_ready after this call is executed.
+        """
+        self._accept_path(points)
+        return self.is_ready()
+
+    def _accept_path(self, points):
+        """
+        Where the actual work of accepting a path is done. By default, each
+        segment of the path is accepted as a drag of its own.
+        """
+        for (start_x, start_y), (end_x, end_y) in zip(points, points[1:]):
+            self._accept_drag(start_x, start_y, end_x, end_y)
+
+    def accept_release(self, x, y, modifiers):
+        """
+        Send a mouse release to this tool. Returns the result of is_ready after this
+        call is executed.
+        """
+        self._accept_release(x, y)
+        return self.is_ready()
+
+    def _accept_release(self, x, y):
+        """
+        Where the actual work of accepting releases is done.
+        """
+
+    def is_ready(self):
+        """
+        Returns True if this tool does not need any more information to form a
+        complete call.
+        """
+        return self._is_ready
+
+    def do(self, canvas):
+        """
+        Run the tool, with the information it has recieved so far, on the given canvas.
+        """
+
+def spans_from_points(points):
+    """
+    Join a collection of (x, y) points into horizontal (y, start_x, end_x)
+    spans, with both ends included.
+    """
+    spans = []
+    start_x = end_x = span_y = None
+    for x, y in sorted(set(points), key=lambda point: (point[1], point[0])):
+        if y == span_y and x == end_x + 1:
+            end_x = x
+        else:
+            if span_y is not None:
+                spans.append((span_y, start_x, end_x))
+            span_y, start_x, end_x = y, x, x
+    if span_y is not None:
+        spans.append((span_y, start_x, end_x))
+    return spans
+
+def plot(canvas, points, color):
+    """
+    Change the color of some pixels on the canvas. Points outside of the
+    canvas are ignored.
+    """
+    canvas.fill_spans(spans_from_points(points), color)
+
+def raster_line(start_x, start_y, end_x, end_y):
+    """
+    Return a list of the coordinates that make up a line.
+
+    Implements the Bresenham line algorithm.
+    """
+    steep = abs(end_y - start_y) > abs(end_x - start_x)
+    if steep:
+        start_x, start_y = start_y, start_x
+        end_x, end_y = end_y, end_x
+    if start_x > end_x:
+        start_x, end_x = end_x, start_x
+        start_y, end_y = end_y, start_y
+    delta_x = end_x -start_x
+    delta_y = abs(end_y - start_y)
+    error = delta_x / 2
+    y = start_y
+    if start_y < end_y:
+        y_step = 1
+    else:
+        y_step = -1
+
+    to_plot = []
+    for x in xrange(start_x, end_x+1):
+        if steep:
+            to_plot.append((y, x))
+        else:
+            to_plot.append((x, y))
+        error -= delta_y
+        if error < 0:
+            y += y_step
+            error += delta_x
+
+    return to_plot
+
+class Pencil(Tool):
+    """
+    A class for drawing simple lines and points on the canvas.
+    """
+
+    def __init__(self, color, ctrl):
+        super(Pencil, self).__init__(color, ctrl)
+        self.to_plot = set()
+
+    def _accept_press(self, x, y):
+        self.to_plot.add((x,y))
+
+    def _accept_drag(self, start_x, start_y, end_x, end_y):
+        self.to_plot.update(raster_line(start_x, start_y, end_x, end_y))
+
+    def _accept_release(self, x, y):
+        self.to_plot.add((x,y))
+        self._is_ready = True
+
+    def do(self, canvas):
+        plot(canvas, self.to_plot, self.color)
+
+class Eraser(Pencil):
+    """
+    Erase some pixels.
+    """
+
+    #noinspection PyUnusedLocal
+    def __init__(self, color, ctrl):
+        super(Eraser, self).__init__((0,0,0,0), ctrl)
+
+class DragTool(Tool):
+    """
+    A tool that accepts only one click, drag, and release before becoming
+    ready.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(DragTool, self).__init__(*args, **kwargs)
+        self.start_x, self.start_y = None, None
+        self.end_x, self.end_y = None, None
+
+    def _accept_press(self, x, y):
+        self.start_x, self.start_y = x, y
+
+    def _accept_drag(self, start_x, start_y, end_x, end_y):
+        self.end_x, self.end_y = end_x, end_y
+
+    def _accept_path(self, points):
+        #only where the drag ends up matters
+        if len(points) > 1:
+            self.end_x, self.end_y = points[-1]
+
+    def _accept_release(self, x, y):
+        self.end_x, self.end_y = x, y
+        self._is_ready = True
+
+class Line(DragTool):
+    """
+    Draw a line.
+    """
+
+    def do(self, canvas):
+        if self.start_x is not None and self.end_x is not None:
+            plot(canvas, raster_line(self.start_x, self.start_y, self.end_x,
+                                     self.end_y), self.color)
+
+def raster_ellipse(start_x, start_y, end_x, end_y):
+    """
+    Generate a set of points describing the outline of an ellipse specified by
+    the given bounding box.
+
+    Implements an integer midpoint algorithm that works from the bounding box
+    itself rather than a center and radii, so ellipses with odd (or even)
+    widths and heights fill their box exactly. The work done is proportional
+    to the length of the outline.
+    """
+    if start_x > end_x:
+        start_x, end_x = end_x, start_x
+    if start_y > end_y:
+        start_y, end_y = end_y, start_y
+
+    a, b = end_x - start_x, end_y - start_y
+    odd_b = b & 1
+    delta_x = 4 * (1 - a) * b * b
+    delta_y = 4 * (odd_b + 1) * a * a
+    error = delta_x + delta_y + odd_b * a * a
+    step_x, step_y = 8 * b * b, 8 * a * a
+
+    #work from the four extreme points of the widest row in towards the middle
+    left, right = start_x, end_x
+    upper = start_y + (b + 1) // 2
+    lower = upper - odd_b
+
+    points = set()
+    while left <= right:
+        points.update(((right, upper), (left, upper),
+                       (left, lower), (right, lower)))
+        doubled_error = 2 * error
+        if doubled_error <= delta_y:
+            upper += 1
+            lower -= 1
+            delta_y += step_y
+            error += delta_y
+        if doubled_error >= delta_x or 2 * error > delta_y:
+            left += 1
+            right -= 1
+            delta_x += step_x
+            error += delta_x
+
+    #very flat ellipses stop too early, so finish off their pointy ends
+    while upper - lower <= b:
+        points.update(((left - 1, upper), (right + 1, upper),
+                       (left - 1, lower), (right + 1, lower)))
+        upper += 1
+        lower -= 1
+
+    return points
+
+class HollowCircle(DragTool):
+    """
+    Draw a hollow circle.
+    """
+    def do(self, canvas):
+        if self.start_x is not None and self.end_x is not None:
+            plot(canvas, raster_ellipse(self.start_x, self.start_y, self.end_x,
+                                        self.end_y), self.color)
+
+def fill_ellipse(points):
+    """
+    Returns the (y, start_x, end_x) spans that fill in an ellipse, given the
+    points of its outline. Each row of the outline becomes one span.
+    """
+    rows = {}
+    for x, y in points:
+        if y in rows:
+            start_x, end_x = rows[y]
+            rows[y] = min(start_x, x), max(end_x, x)
+        else:
+            rows[y] = x, x
+    return [(y, left, right) for y, (left, right) in rows.iteritems()]
+
+class Circle(DragTool):
+    """
+    Draw a filled-in circle.
+    """
+    def do(self, canvas):
+        if self.start_x is not None and self.end_x is not None:
+            points = raster_ellipse(self.start_x, self.start_y, self.end_x,
+                                    self.end_y)
+            canvas.fill_spans(fill_ellipse(points), self.color)
+
+class Rectangle(DragTool):
+    """
+    Draw a rectangle.
+    """
+    def do(self, canvas):
+        if self.start_x is not None and self.end_x is not None:
+            start_x, start_y = self.start_x, self.start_y
+            end_x, end_y = self.end_x, self.end_y
+            if start_x > end_x:
+                start_x, end_x = end_x, start_x
+            if start_y > end_y:
+                start_y, end_y = end_y, start_y
+
+            canvas.fill_rect(start_x, start_y, end_x - start_x + 1,
+                             end_y - start_y + 1, self.color)
+
+class HollowRectangle(DragTool):
+    """
+    Draw a hollow rectangle.
+    """
+    def do(self, canvas):
+        if self.start_x is not None and self.end_x is not None:
+            start_x, start_y = self.start_x, self.start_y
+            end_x, end_y = self.end_x, self.end_y
+            if start_x > end_x:
+                start_x, end_x = end_x, start_x
+            if start_y > end_y:
+                start_y, end_y = end_y, start_y
+
+            width, height = end_x - start_x + 1, end_y - start_y + 1
+            canvas.fill_rect(start_x, start_y, width, 1, self.color)
+            canvas.fill_rect(start_x, end_y, width, 1, self.color)
+            canvas.fill_rect(start_x, start_y, 1, height, self.color)
+            canvas.fill_rect(end_x, start_y, 1, height, self.color)
+
+class ClickTool(Tool):
+    """
+    A tool that accepts only one click and release before being ready.
+    """
+
+    previews = False
+
+    def __init__(self, *args, **kwargs):
+        super(ClickTool, self).__init__(*args, **kwargs)
+        self.x, self.y = None, None
+
+    def _accept_press(self, x, y):
+        self.x, self.y = x, y
+
+    def _accept_release(self, x, y):
+        self._is_ready = True
+
+def color_matcher(target, tolerance):
+    """
+    Returns a function that tells whether a packed 32 bit color is within
+    tolerance of the target on every one of its channels.
+    """
+    if not tolerance:
+        return lambda color: color == target
+
+    target_channels = [(target >> shift) & 255 for shift in (0, 8, 16, 24)]
+    def matches(color):
+        for shift, channel in zip((0, 8, 16, 24), target_channels):
+            if abs(((color >> shift) & 255) - channel) > tolerance:
+                return False
+        return True
+    return matches
+
+def scan_fill(pixels, width, height, x, y, tolerance=0, diagonal=False):
+    """
+    Find the area of similar color around a starting pixel.
+
+    The pixels are a flat sequence of packed colors, width pixels to a row.
+    Returns a list of (y, start_x, end_x) spans, inclusive, that cover the area.
+    With diagonal set, pixels that only touch at a corner are connected too.
+    """
+    matches = color_matcher(pixels[y * width + x], tolerance)
+    filled = bytearray(width * height)
+
+    spans = []
+    to_scan = [(x, y)]
+    while to_scan:
+        x, y = to_scan.pop()
+        row = y * width
+        if filled[row + x]:
+            continue
+
+        start_x = x
+        while start_x > 0 and not filled[row + start_x - 1] and \
+                matches(pixels[row + start_x - 1]):
+            start_x -= 1
+        end_x = x
+        while end_x < width - 1 and not filled[row + end_x + 1] and \
+                matches(pixels[row + end_x + 1]):
+            end_x += 1
+        filled[row + start_x:row + end_x + 1] = "\x01" * (end_x - start_x + 1)
+        spans.append((y, start_x, end_x))
+
+        if diagonal:
+            scan_start, scan_end = max(start_x - 1, 0), min(end_x + 1, width - 1)
+        else:
+            scan_start, scan_end = start_x, end_x
+        for next_y in (y - 1, y + 1):
+            if not 0 <= next_y < height:
+                continue
+            next_row = next_y * width
+            in_span = False
+            for next_x in xrange(scan_start, scan_end + 1):
+                if not filled[next_row + next_x] and \
+                        matches(pixels[next_row + next_x]):
+                    if not in_span:
+                        to_scan.append((next_x, next_y))
+                        in_span = True
+                else:
+                    in_span = False
+
+    return spans
+
+class FloodFill(ClickTool):
+    """
+    Fill the areas adjacent to a selected pixel that are also that pixel's
+    color in a different color.
+    """
+
+    #how far each color channel may be from the selected pixel's and still fill
+    tolerance = 0
+    #whether pixels that only touch at the corners count as adjacent
+    diagonal = False
+
+    def do(self, canvas):
+        if self.x is None:
+            return
+        if not (0 <= self.x < canvas.width and 0 <= self.y < canvas.height):
+            return
+        if not self.tolerance and \
+                list(canvas.get_pixel(self.x, self.y)) == list(self.color):
+            return
+
+        pixels = array("I")
+        pixels.fromstring(str(canvas.get_composite()))
+        canvas.fill_spans(scan_fill(pixels, canvas.width, canvas.height,
+                                    self.x, self.y, self.tolerance,
+                                    self.diagonal), self.color)
+
+class KillEraser(ClickTool):
+    """
+    Erase an entire tile.
+    """
+    def do(self, canvas):
+        if self.x is None:
+            return
+        if 0 <= self.x < canvas.width and 0 <= self.y < canvas.height:
+            tile_x, tile_y = canvas.get_tile(self.x, self.y)
+            canvas.erase_tile(tile_x, tile_y)
+
+class EyeDropper(ClickTool):
+    """
+    Pick a current color from one already on the canvas.
+    """
+
+    def accept_release(self, x, y, modifiers):
+        self.x, self.y = x, y
+        if pyglet.window.key.MOD_CTRL & modifiers:
+            self.to_replace = "right"
+        else:
+            self.to_replace = "left"
+        self._is_ready = True
+        return self.is_ready()
+
+    def do(self, canvas):
+        if not self.is_ready():
+            return
+        if not (0 <= self.x < canvas.width and 0 <= self.y < canvas.height):
+            return
+        new_color = canvas.get_pixel(self.x, self.y)
+        if new_color[3] == 0:
+            new_color = [int(c*255) for c in self.ctrl.background_color[:3]]
+        if self.to_replace == "left":
+            self.ctrl.left_color = new_color
+            self.ctrl.update_tool_colors()
+        elif self.to_replace == "right":
+            self.ctrl.right_color = new_color
+            self.ctrl.update_tool_colors()
+
+class TilePlacer(ClickTool):
+    """
+    Place a tile from the tile list into a place on the canvas.
+
+    The tile placed is the one picked in the tileset manager, or in a script,
+    the tile_id set on the tool, shown with the tool's rotation and flips.
+    Clicking with ctrl held picks the tile shown in that place instead.
+    """
+
+    tile_id = None
+    rotation = 0
+    flip_x = False
+    flip_y = False
+
+    def __init__(self, *args, **kwargs):
+        super(TilePlacer, self).__init__(*args, **kwargs)
+        if self.ctrl is not None:
+            self.tile_id = self.ctrl.selected_tile
+        self.picking = False
+
+    def accept_release(self, x, y, modifiers):
+        self.picking = bool(pyglet.window.key.MOD_CTRL & modifiers)
+        return super(TilePlacer, self).accept_release(x, y, modifiers)
+
+    def do(self, canvas):
+        if self.x is None:
+            return
+        if not (0 <= self.x < canvas.width and 0 <= self.y < canvas.height):
+            return
+        tile_x, tile_y = canvas.get_tile(self.x, self.y)
+        if self.picking:
+            if self.ctrl is not None:
+                self.ctrl.select_library_tile(canvas.tiles[tile_y][tile_x].tile_id)
+        elif self.tile_id is not None:
+            canvas.place_tile(tile_x, tile_y, self.tile_id, self.rotation,
+                              self.flip_x, self.flip_y)
+
+class GlobalColorReplace(ClickTool):
+    """
+    Replace one color with another across the whole canvas.
+    """
+
+    def do(self, canvas):
+        if self.x is None:
+            return
+        if 0 <= self.x < canvas.width and 0 <= self.y < canvas.height:
+            canvas.replace_color(canvas.get_pixel(self.x, self.y), self.color)
+
+class LocalColorReplace(ClickTool):
+    """
+    Replace one color with another across one tile.
+    """
+
+    #pairs of [old color, new color] to remap all at once, such as a palette
+    #swap; without any, the color clicked on is replaced with the tool's color
+    colors = None
+
+    def do(self, canvas):
+        if self.x is None:
+            return
+        if not (0 <= self.x < canvas.width and 0 <= self.y < canvas.height):
+            return
+        if self.colors:
+            table = dict((tuple(old), tuple(new)) for old, new in self.colors)
+        else:
+            table = {tuple(canvas.get_pixel(self.x, self.y)): self.color}
+        tile_x, tile_y = canvas.get_tile(self.x, self.y)
+        canvas.remap_tile_colors(tile_x, tile_y, table)
+
+class Filmstrip(DragTool):
+    """
+    Play back an animation of the tiles dragged across, one tile to a frame.
+    The frames are read along each row from the left, starting with the top
+    row.
+    """
+
+    previews = False
+    fps = 8
+
+    def get_frames(self, canvas):
+        """
+        Returns the (tile_x, tile_y) of each tile between where the drag
+        started and ended, in the order they are played.
+        """
+        if self.start_x is None or self.end_x is None:
+            return []
+        columns, rows = canvas.canvas_size
+        start_x, start_y = canvas.get_tile(self.start_x, self.start_y)
+        end_x, end_y = canvas.get_tile(self.end_x, self.end_y)
+        left, right = max(min(start_x, end_x), 0), min(max(start_x, end_x),
+                                                       columns - 1)
+        bottom, top = max(min(start_y, end_y), 0), min(max(start_y, end_y),
+                                                       rows - 1)
+        return [(tile_x, tile_y) for tile_y in xrange(top, bottom - 1, -1)
+                for tile_x in xrange(left, right + 1)]
+
+    def do(self, canvas):
+        frames = self.get_frames(canvas)
+        if frames and self.ctrl is not None:
+            self.ctrl.play_animation(frames, self.fps)
+
+tool_list = [Pencil, Eraser, KillEraser, Line, Rectangle, HollowRectangle,
+             Circle, HollowCircle, EyeDropper, TilePlacer, FloodFill,
+             LocalColorReplace, GlobalColorReplace, Filmstrip]
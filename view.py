@@ -1,11 +1,51 @@
 __author__ = 'cseebach'
 
-from tkColorChooser import askcolor
-import Tkinter
+import math
 
 import pyglet
 from pyglet import gl
 
+class Images(object):
+    """
+    The images the views are drawn with.
+
+    Nothing is read until an image is first asked for, and then every image is
+    packed into one shared texture atlas, so the views draw from one texture.
+    """
+
+    atlas_size = 512, 256
+
+    def __init__(self):
+        self.atlas = None
+        self.loaded = {}
+
+    def __getitem__(self, name):
+        if name not in self.loaded:
+            if self.atlas is None:
+                pyglet.resource.path += ["res/normal", "res/alpha"]
+                pyglet.resource.reindex()
+                self.atlas = pyglet.image.atlas.TextureAtlas(*self.atlas_size)
+            image = pyglet.image.load(name, file=pyglet.resource.file(name))
+            self.loaded[name] = self.atlas.add(image)
+        return self.loaded[name]
+
+images = Images()
+
+tk_root = None
+
+def ask_color():
+    """
+    Ask for a color with Tk's color chooser. Returns an RGB tuple, or None if
+    no color was chosen. Tk is only started the first time this is called.
+    """
+    global tk_root
+    from tkColorChooser import askcolor
+    if tk_root is None:
+        import Tkinter
+        tk_root = Tkinter.Tk()
+        tk_root.iconify()
+    return askcolor()[0]
+
 class SelfRegistrant(pyglet.window.Window):
 
     dispatches = []
@@ -17,20 +57,33 @@ class SelfRegistrant(pyglet.window.Window):
             self.register_event_type(event_type)
 
 class CanvasView(SelfRegistrant):
+    """
+    Shows the canvas through a viewport that can be zoomed and panned, so a
+    canvas bigger than the window can still be worked on. Scrolling the mouse
+    wheel zooms in and out around the pointer, and dragging with the middle
+    button pans.
+    """
 
     dispatches = ["on_canvas_press", "on_canvas_drag", "on_canvas_release",
                   "on_canvas_draw"]
 
+    min_scale = 0.25
+    max_scale = 64
+    zoom_step = 1.25
+
     def __init__(self, *args, **kwargs):
         super(CanvasView, self).__init__(*args, **kwargs)
 
         self.scale = kwargs.get("scale", 8)
+        #where the bottom left corner of the canvas is in the window
+        self.origin = 0, 0
         self.preview = None
 
         self.draw_grid = True
         self.draw_borders = True
 
         self.highlighted_cell = None
+        self.stats_label = None
 
     def set_canvas(self, canvas):
         self.canvas = canvas
@@ -38,87 +91,191 @@ class CanvasView(SelfRegistrant):
         self.tile_size = canvas.tile_size
 
     def fit_to_canvas(self):
-        new_w = self.canvas.width * self.scale
-        new_h = self.canvas.height * self.scale
-        self.set_size(new_w, new_h)
+        """
+        Size the window to show the whole canvas at the current scale, but no
+        bigger than most of the screen. A bigger canvas is panned around in
+        the window instead.
+        """
+        new_w = min(int(math.ceil(self.canvas.width * self.scale)),
+                    self.screen.width * 3 // 4)
+        new_h = min(int(math.ceil(self.canvas.height * self.scale)),
+                    self.screen.height * 3 // 4)
+        self.set_size(max(new_w, 1), max(new_h, 1))
+        self.pan_to(*self.origin)
+
+    def pan_to(self, origin_x, origin_y):
+        """
+        Move the bottom left corner of the canvas to a point in the window. The
+        canvas is kept from leaving the window: a canvas smaller than the
+        window sits at its bottom left, and a bigger one always fills it.
+        """
+        shown_w = self.canvas.width * self.scale
+        shown_h = self.canvas.height * self.scale
+        self.origin = (min(max(origin_x, self.width - shown_w), 0),
+                       min(max(origin_y, self.height - shown_h), 0))
+
+    def zoom_to(self, scale, x=None, y=None):
+        """
+        Change the scale, keeping the canvas pixel under a point of the window
+        in place. The point is the middle of the window by default.
+        """
+        if x is None:
+            x, y = self.width / 2.0, self.height / 2.0
+        scale = min(max(scale, self.min_scale), self.max_scale)
+        ratio = scale / float(self.scale)
+        self.scale = scale
+        origin_x, origin_y = self.origin
+        self.pan_to(x - (x - origin_x) * ratio, y - (y - origin_y) * ratio)
+
+    def zoom_by(self, steps, x=None, y=None):
+        """
+        Zoom in by a number of zoom steps, or out by a negative number, around
+        a point of the window as zoom_to does.
+        """
+        self.zoom_to(self.scale * self.zoom_step ** steps, x, y)
+
+    def to_canvas_coords(self, x, y):
+        """
+        Returns the canvas pixel under a point of the window. Points outside of
+        the canvas give pixels outside of it too.
+        """
+        origin_x, origin_y = self.origin
+        return (int(math.floor((x - origin_x) / float(self.scale))),
+                int(math.floor((y - origin_y) / float(self.scale))))
+
+    def get_visible_cells(self):
+        """
+        Returns the rectangle of cells that can be seen in the window, as
+        (left, bottom, right, top) with right and top just past the last column
+        and row.
+        """
+        cell_w = self.tile_size[0] * float(self.scale)
+        cell_h = self.tile_size[1] * float(self.scale)
+        origin_x, origin_y = self.origin
+        return (int(math.floor(-origin_x / cell_w)),
+                int(math.floor(-origin_y / cell_h)),
+                int(math.ceil((self.width - origin_x) / cell_w)),
+                int(math.ceil((self.height - origin_y) / cell_h)))
 
     def on_expose(self):
         #need an empty method here to have pyglet redraw on unhide
         pass
 
+    def on_resize(self, width, height):
+        super(CanvasView, self).on_resize(width, height)
+        if hasattr(self, "canvas"):
+            self.pan_to(*self.origin)
+
     def on_draw(self):
         self.dispatch_event("on_canvas_draw")
 
     def on_mouse_press(self, x, y, buttons, modifiers):
+        if buttons & pyglet.window.mouse.MIDDLE:
+            return
         self.dispatch_event("on_canvas_press", x, y, buttons, modifiers)
 
     def on_mouse_drag(self, x, y, dx, dy, buttons, modifiers):
+        if buttons & pyglet.window.mouse.MIDDLE:
+            self.pan_to(self.origin[0] + dx, self.origin[1] + dy)
+            return
         self.dispatch_event("on_canvas_drag", x, y, dx, dy, buttons, modifiers)
 
     def on_mouse_release(self, x, y, buttons, modifiers):
+        if buttons & pyglet.window.mouse.MIDDLE:
+            return
         self.dispatch_event("on_canvas_release", x, y, buttons, modifiers)
 
+    def on_mouse_scroll(self, x, y, scroll_x, scroll_y):
+        self.zoom_by(scroll_y, x, y)
+
     def on_mouse_motion(self, x, y, dx, dy):
-        self.highlighted_cell = (x/self.scale)//self.tile_size[0], (y/self.scale)//self.tile_size[1]
+        pix_x, pix_y = self.to_canvas_coords(x, y)
+        self.highlighted_cell = pix_x//self.tile_size[0], pix_y//self.tile_size[1]
 
-    def draw_canvas(self, canvas):
-        sprites, batch = canvas.get_sprites(self.scale)
-        batch.draw()
+    def draw_canvas(self, canvas, overlay=None, background_color=None):
+        gl.glPushMatrix()
+        gl.glTranslatef(self.origin[0], self.origin[1], 0)
+
+        canvas.get_batch(self.scale, self.get_visible_cells()).draw()
+
+        if overlay:
+            self.draw_overlay(overlay, background_color)
 
         if self.highlighted_cell and self.draw_borders:
             h_x, h_y = self.highlighted_cell
+            cell_w = self.scale * self.tile_size[0]
+            cell_h = self.scale * self.tile_size[1]
+            left, bottom = h_x * cell_w, h_y * cell_h
+            right, top = left + cell_w, bottom + cell_h
 
             gl.glLineWidth(2.0)
 
             pyglet.graphics.draw(8, gl.GL_LINES,
-                ("v2i", (h_x*self.scale*self.tile_size[0],
-                         h_y*self.scale*self.tile_size[1],
-
-                         h_x*self.scale*self.tile_size[0],
-                         (h_y+1)*self.scale*self.tile_size[1],
-
-                         h_x*self.scale*self.tile_size[0],
-                         (h_y+1)*self.scale*self.tile_size[1],
-
-                         (h_x+1)*self.scale*self.tile_size[0],
-                         (h_y+1)*self.scale*self.tile_size[1],
-
-                         (h_x+1)*self.scale*self.tile_size[0],
-                         (h_y+1)*self.scale*self.tile_size[1],
-
-                         (h_x+1)*self.scale*self.tile_size[0],
-                         h_y*self.scale*self.tile_size[1],
-
-                         (h_x+1)*self.scale*self.tile_size[0],
-                         h_y*self.scale*self.tile_size[1],
-
-                         h_x*self.scale*self.tile_size[0],
-                         h_y*self.scale*self.tile_size[1],)),
+                ("v2f", (left, bottom, left, top,
+                         left, top, right, top,
+                         right, top, right, bottom,
+                         right, bottom, left, bottom)),
                 ("c3B", (0,0,0,255,255,255)*4))
 
-pyglet.resource.path += ["res/normal", "res/alpha"]
-pyglet.resource.reindex()
+        gl.glPopMatrix()
+
+    def draw_overlay(self, overlay, background_color):
+        """
+        Draw the rects of an overlay as quads over the canvas, one quad a
+        rect. Pixels that have been made transparent show the background
+        color.
+        """
+        if not overlay.rects:
+            return
+
+        erased = tuple(int(c * 255) for c in background_color[:3]) + (255,)
+        vertices, colors = [], []
+        for x, y, width, height, color in overlay.rects:
+            left, bottom = x * self.scale, y * self.scale
+            right = left + width * self.scale
+            top = bottom + height * self.scale
+            vertices.extend((left, bottom, left, top, right, top, right, bottom))
+            if color[3] == 0:
+                color = erased
+            colors.extend(color * 4)
+
+        pyglet.graphics.draw(len(vertices) // 2, gl.GL_QUADS,
+            ("v2f", vertices),
+            ("c4B", colors))
+        gl.glColor4ub(255, 255, 255, 255)
+
+    def draw_stats(self, lines):
+        """
+        Draw lines of counters and timings over the top left of the canvas.
+        """
+        if self.stats_label is None:
+            self.stats_label = pyglet.text.Label(
+                font_size=9, color=(255, 255, 0, 255), multiline=True,
+                width=self.width, anchor_y="top")
+        self.stats_label.text = "\n".join(lines)
+        self.stats_label.x, self.stats_label.y = 4, self.height - 4
+        self.stats_label.draw()
 
 class ToolboxView(SelfRegistrant):
     """
     A window that holds all the tools in the toolbox.
     """
 
-    dispatches = ["on_tool_selected", "on_scale_changed", "on_color_selected",
-                  "on_bg_color_selected"]
+    dispatches = ["on_tool_selected", "on_zoom_stepped", "on_color_selected",
+                  "on_bg_color_selected", "on_palette_changed"]
 
     tool_icons = ["pencil.png", "eraser.png", "killeraser.png", "line.png",
                   "rectangle.png", "hollowrectangle.png", "circle.png",
                   "hollowcircle.png", "eyedropper.png", "tileplacer.png",
                   "fillbucket.png", "localreplace.png", "globalreplace.png",
                   "animation.png"]
-    tool_alpha = [pyglet.resource.image("res/alpha/"+loc) for loc in tool_icons]
-    tool_icons = [pyglet.resource.image("res/normal/"+loc) for loc in tool_icons]
+    tool_alpha = ["res/alpha/"+loc for loc in tool_icons]
+    tool_icons = ["res/normal/"+loc for loc in tool_icons]
     tool_w, tool_h = 32, 32
     tool_loc = [((tool_w+1) * i, 40) for i, icon in enumerate(tool_icons)]
     tools = zip(range(len(tool_icons)), tool_loc, tool_icons)
 
-    highlight = pyglet.resource.image("res/highlight.png")
+    highlight = "res/highlight.png"
 
     swatch_w, swatch_h = 16, 16
     swatch_loc = [(66 + 17 * i, 0) for i in xrange(20)]
@@ -126,12 +283,9 @@ class ToolboxView(SelfRegistrant):
 
     arrow_w, arrow_h = 24, 24
     minus_loc = 17*20+65, 0
-    minus = pyglet.resource.image("res/minus.png")
+    minus = "res/minus.png"
     plus_loc = minus_loc[0] + arrow_w + 1, minus_loc[1]
-    plus = pyglet.resource.image("res/plus.png")
-
-    tk_root = Tkinter.Tk()
-    tk_root.iconify()
+    plus = "res/plus.png"
 
     def __init__(self, *args, **kwargs):
         kwargs.setdefault("width", self.tool_loc[-1][0]+60)
@@ -150,8 +304,6 @@ class ToolboxView(SelfRegistrant):
 
         self.background_color = (0, 0, 0)
 
-        self.scale = 8
-
     def on_expose(self):
     #need an empty method here to have pyglet redraw on unhide
         pass
@@ -179,7 +331,10 @@ class ToolboxView(SelfRegistrant):
         elif self.over_palette_swatch(x, y):
             swatch, index = self.get_palette_swatch(x, y)
             if pyglet.window.key.MOD_CTRL & modifers:
-                self.palette[index] = askcolor()[0] or self.palette[index]
+                new_color = ask_color()
+                if new_color:
+                    self.palette[index] = new_color
+                    self.dispatch_event("on_palette_changed", index)
             elif pyglet.window.mouse.LEFT & buttons:
                 self.dispatch_event("on_color_selected", swatch,
                                     "left")
@@ -189,13 +344,11 @@ class ToolboxView(SelfRegistrant):
                                     "right")
                 self.right_color = swatch
         elif self.scale_increased(x, y):
-            self.scale += 1
-            self.dispatch_event("on_scale_changed", self.scale)
+            self.dispatch_event("on_zoom_stepped", 1)
         elif self.scale_decreased(x ,y):
-            self.scale = max(1, self.scale - 1)
-            self.dispatch_event("on_scale_changed", self.scale)
+            self.dispatch_event("on_zoom_stepped", -1)
         elif x > self.tool_loc[-1][0] and y > self.tool_loc[-1][1]:
-            new_bg_color = askcolor()[0]
+            new_bg_color = ask_color()
             if new_bg_color:
                 self.background_color = new_bg_color
                 self.dispatch_event("on_bg_color_selected", new_bg_color)
@@ -266,24 +419,171 @@ class ToolboxView(SelfRegistrant):
 
         self.clear()
         for i, location, icon in self.tools:
-            icon.blit(*location)
+            images[icon].blit(*location)
             if self.highlighted == i:
-                self.highlight.blit(*location)
-        self.minus.blit(*self.minus_loc)
-        self.plus.blit(*self.plus_loc)
+                images[self.highlight].blit(*location)
+        images[self.minus].blit(*self.minus_loc)
+        images[self.plus].blit(*self.plus_loc)
 
         self.draw_palette()
 
-        self.tool_alpha[self.left_tool].blit(0, 0)
-        self.tool_alpha[self.right_tool].blit(33, 0)
+        images[self.tool_alpha[self.left_tool]].blit(0, 0)
+        images[self.tool_alpha[self.right_tool]].blit(33, 0)
 
 class TilesetManagerView(SelfRegistrant):
+    """
+    A window that shows every tile in the tile library, for picking the one
+    the tile placer places.
+    """
+
+    dispatches = ["on_library_tile_selected", "on_library_tile_added",
+                  "on_library_tile_removed", "on_library_purged"]
+
+    tile_select = "res/tileselect.png"
+    tile_delete = "res/tiledelete.png"
+    tile_number = "res/tilenumber.png"
+    minus = "res/minus.png"
+    plus = "res/plus.png"
+
+    button_w, button_h = 32, 32
+    tile_delete_loc = 0, 0
+    tile_number_loc = button_w + 1, 0
+    arrow_w, arrow_h = 24, 24
+    minus_loc = 2 * (button_w + 1), 4
+    plus_loc = minus_loc[0] + arrow_w + 1, 4
 
-    tile_select = pyglet.resource.image("res/tileselect.png")
-    tile_delete = pyglet.resource.image("res/tiledelete.png")
-    tile_number = pyglet.resource.image("res/tilenumber.png")
-    minus = pyglet.resource.image("res/minus.png")
-    plus = pyglet.resource.image("res/plus.png")
+    tile_scale = 2
+    tile_gap = 4
+
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault("width", 256)
+        kwargs.setdefault("height", 256)
+        super(TilesetManagerView, self).__init__(*args, **kwargs)
+
+        self.canvas = None
+        self.selected = None
+        self.show_numbers = False
+
+    def on_expose(self):
+        #need an empty method here to have pyglet redraw on unhide
+        pass
+
+    def set_canvas(self, canvas):
+        """
+        Show the tiles in a canvas's library. They are drawn from the canvas's
+        texture atlas, so they aren't uploaded a second time.
+        """
+        self.canvas = canvas
+
+    def get_tile_locations(self):
+        """
+        Returns the id and window position of each library tile, laid out in
+        rows from the top left that fit the window's width.
+        """
+        tile_w, tile_h = self.canvas.tile_size
+        cell_w = tile_w * self.tile_scale + self.tile_gap
+        cell_h = tile_h * self.tile_scale + self.tile_gap
+        columns = max(1, self.width // cell_w)
+        return [(tile_id, (i % columns) * cell_w + self.tile_gap,
+                 self.height - (i // columns + 1) * cell_h)
+                for i, tile_id in enumerate(self.canvas.library)]
+
+    def over(self, location, width, height, x, y):
+        return (location[0] <= x < location[0] + width and
+                location[1] <= y < location[1] + height)
+
+    def on_mouse_release(self, x, y, buttons, modifiers):
+        if self.canvas is None:
+            return
+        if self.over(self.tile_delete_loc, self.button_w, self.button_h, x, y):
+            self.dispatch_event("on_library_purged")
+        elif self.over(self.tile_number_loc, self.button_w, self.button_h, x, y):
+            self.show_numbers = not self.show_numbers
+        elif self.over(self.minus_loc, self.arrow_w, self.arrow_h, x, y):
+            if self.selected is not None:
+                self.dispatch_event("on_library_tile_removed", self.selected)
+        elif self.over(self.plus_loc, self.arrow_w, self.arrow_h, x, y):
+            self.dispatch_event("on_library_tile_added")
+        else:
+            tile_w, tile_h = self.canvas.tile_size
+            for tile_id, t_x, t_y in self.get_tile_locations():
+                if self.over((t_x, t_y), tile_w * self.tile_scale,
+                             tile_h * self.tile_scale, x, y):
+                    self.selected = tile_id
+                    self.dispatch_event("on_library_tile_selected", tile_id)
+                    break
+
+    def on_draw(self):
+        pyglet.gl.glClearColor(.25,.25,.25,1.0)
+        self.clear()
+        images[self.tile_delete].blit(*self.tile_delete_loc)
+        images[self.tile_number].blit(*self.tile_number_loc)
+        images[self.minus].blit(*self.minus_loc)
+        images[self.plus].blit(*self.plus_loc)
+        if self.canvas is None:
+            return
+
+        tile_w, tile_h = self.canvas.tile_size
+        width, height = tile_w * self.tile_scale, tile_h * self.tile_scale
+        for tile_id, x, y in self.get_tile_locations():
+            region = self.canvas.get_atlas_region(
+                self.canvas.library[tile_id])
+            region.blit(x, y, width=width, height=height)
+            if tile_id == self.selected:
+                images[self.tile_select].blit(x, y, width=width, height=height)
+            if self.show_numbers:
+                pyglet.text.Label(str(tile_id), font_size=8, x=x + 1,
+                                  y=y + 1).draw()
+
+class AnimationView(SelfRegistrant):
+    """
+    A window that plays back an animation of canvas tiles. Space pauses and
+    resumes it, and the up and down arrows change its speed.
+    """
+
+    scale = 4
+
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault("width", 128)
+        kwargs.setdefault("height", 128)
+        super(AnimationView, self).__init__(*args, **kwargs)
+
+        self.animation = None
+
+    def on_expose(self):
+        #need an empty method here to have pyglet redraw on unhide
+        pass
+
+    def set_animation(self, animation):
+        self.animation = animation
+        width, height = animation.get_size()
+        self.set_size(width * self.scale, height * self.scale)
+
+    def on_key_press(self, symbol, modifiers):
+        if self.animation is None:
+            return
+        if symbol == pyglet.window.key.SPACE:
+            if self.animation.playing:
+                self.animation.stop()
+            else:
+                self.animation.play()
+        elif symbol == pyglet.window.key.UP:
+            self.animation.set_fps(self.animation.fps + 1)
+        elif symbol == pyglet.window.key.DOWN:
+            self.animation.set_fps(self.animation.fps - 1)
+
+    def on_close(self):
+        #only hide, so the window can be shown again for the next animation
+        if self.animation is not None:
+            self.animation.stop()
+        self.set_visible(False)
+        return pyglet.event.EVENT_HANDLED
+
+    def on_draw(self):
+        pyglet.gl.glClearColor(.25,.25,.25,1.0)
+        self.clear()
+        if self.animation is not None:
+            self.animation.draw(0, 0, self.scale)
 
 class SlammerView(object):
     """
@@ -293,10 +593,13 @@ class SlammerView(object):
     def __init__(self):
         self.canvas = CanvasView(visible=False)
         self.toolbox = ToolboxView(visible=False)
+        self.tileset = TilesetManagerView(visible=False)
+        self.animation = AnimationView(visible=False)
 
         gl.glEnable(gl.GL_BLEND)
         gl.glBlendFunc(gl.GL_SRC_ALPHA, gl.GL_ONE_MINUS_SRC_ALPHA)
 
     def push_handlers(self, handler):
         self.canvas.push_handlers(handler)
-        self.toolbox.push_handlers(handler)
\ No newline at end of file
+        self.toolbox.push_handlers(handler)
+        self.tileset.push_handlers(handler)
\ No newline at end of file